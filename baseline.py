@@ -0,0 +1,176 @@
+# ====================
+# ベースラインのプレイヤー（モンテカルロ法・モンテカルロ木探索）
+# ====================
+
+# ワーカープロセスが軽く起動するようTensorFlowを読み込まない
+
+# パッケージのインポート
+from game import random_playout
+import multiprocessing as mp
+import random
+import math
+
+
+def argmax(collection, key=None):
+    return collection.index(max(collection))
+
+
+def playout(state):
+    # 終局までランダムに行動を選び、開始局面の手番から見た価値を返す
+    # （Stateを生成しないビットボードのプレイアウトを使う）
+    return random_playout(state)
+
+
+# モンテカルロ
+PLAYOUT_NUM = 100
+
+# ルート並列化
+BASELINE_PROCESS_NUM = 1  # 探索を分担するワーカープロセス数（1は並列化なし）
+
+_pool = None
+
+
+def get_pool():
+    # ワーカープールの取得（手ごとに起動しないよう使い回す）
+    # TensorFlowを初期化済みのプロセスからforkしないようspawnで起動
+    global _pool
+    if _pool is None:
+        _pool = mp.get_context('spawn').Pool(
+            BASELINE_PROCESS_NUM, initializer=random.seed)
+    return _pool
+
+
+def close_pool():
+    # ワーカープールの終了
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+def split_count(count, process_num):
+    # 試行回数をワーカーごとに分配
+    return [count // process_num + (1 if i < count % process_num else 0)
+            for i in range(process_num)]
+
+
+def root_parallel(f, state, count):
+    # 試行回数をワーカーで分担し、合法手ごとの結果を合計
+    if BASELINE_PROCESS_NUM <= 1:
+        return f(state, count)
+    counts = split_count(count, BASELINE_PROCESS_NUM)
+    results = get_pool().starmap(f, [(state, c) for c in counts if c])
+    return [sum(values) for values in zip(*results)]
+
+
+def mcs_values(state, playout_num):
+    # 合法手ごとのプレイアウトの累計価値
+    legal_actions = state.legal_actions()
+    values = [0] * len(legal_actions)
+    for i, action in enumerate(legal_actions):
+        next_state = state.next(action)
+        for _ in range(playout_num):
+            values[i] += -playout(next_state)
+    return values
+
+
+def mcs_action(state):
+    legal_actions = state.legal_actions()
+    values = root_parallel(mcs_values, state, PLAYOUT_NUM)
+    return legal_actions[argmax(values)]
+
+
+# モンテカルロ木探索
+MCTS_EVALUATE_COUNT = 100
+
+
+def mcts_actions(state):
+    legal_actions = state.legal_actions()
+    n_list = root_parallel(mcts_scores, state, MCTS_EVALUATE_COUNT)
+    return legal_actions[argmax(n_list)]
+
+
+def mcts_scores(state, evaluate_count):
+    # 根ノードの子ノードごとの試行回数
+    # モンテカルロ木探索のノードの定義
+    class Node:
+        # ノードの初期化
+        def __init__(self, state):
+            self.state = state  # 状態
+            self.w = 0  # 累計価値
+            self.n = 0  # 試行回数
+            self.child_nodes = None  # 子ノード群
+
+        # 局面の価値の計算
+        def evaluate(self):
+            # ゲーム終了時
+            if self.state.is_done():
+                # 勝敗結果で価値を取得
+                value = -1 if self.state.is_lose() else 0
+
+                # 累計価値と試行回数の更新
+                self.w += value
+                self.n += 1
+                return value
+
+            # 子ノードが存在しない時
+            if not self.child_nodes:
+                value = playout(self.state)
+
+                # 累計価値と試行回数の更新
+                self.w += value
+                self.n += 1
+
+                if self.n == 10:
+                    self.expand()
+                return value
+
+            # 子ノードが存在する時
+            else:
+
+                value = -self.next_child_node().evaluate()
+
+                # 累計価値と試行回数の更新
+                self.w += value
+                self.n += 1
+                return value
+
+        def expand(self):
+            legal_actions = self.state.legal_actions()
+            self.child_nodes = []
+            for action in legal_actions:
+                self.child_nodes.append(Node(self.state.next(action)))
+
+        # アーク評価値が最大の子ノードを取得
+        def next_child_node(self):
+
+            for child_node in self.child_nodes:
+                if child_node.n == 0:
+                    return child_node
+
+            t = 0
+            for c in self.child_nodes:
+                t += c.n
+
+            ucb1_values = []
+            for child_node in self.child_nodes:
+                ucb1_values.append(
+                    -child_node.w / child_node.n +
+                    (2*math.log(t) / child_node.n) ** 0.5
+                )
+
+            return self.child_nodes[argmax(ucb1_values)]
+
+    # 現在の局面のノードの作成
+    root_node = Node(state)
+    root_node.expand()
+
+    # 複数回の評価の実行
+    for _ in range(evaluate_count):
+        root_node.evaluate()
+
+    n_list = []
+    for c in root_node.child_nodes:
+        n_list.append(c.n)
+    return n_list
@@ -3,10 +3,7 @@
 # ====================
 
 # パッケージのインポート
-from tensorflow.keras.layers import Activation, Add, BatchNormalization, Conv2D, Dense, GlobalAveragePooling2D, Input
-from tensorflow.keras.models import Model
-from tensorflow.keras.regularizers import l2
-from tensorflow.keras import backend as K
+# （DN_*の定数のみを使うセルフプレイ等でTensorFlowを読み込まないよう、Kerasは各関数内で読み込む）
 import os
 
 BOARD_SIZE = 8
@@ -23,6 +20,9 @@ def conv(filters):
     畳み込み層の作成
     '''
 
+    from tensorflow.keras.layers import Conv2D
+    from tensorflow.keras.regularizers import l2
+
     return Conv2D(filters, 3, padding='same', use_bias=False,
                   kernel_initializer='he_normal', kernel_regularizer=l2(0.0005))
 
@@ -32,6 +32,8 @@ def residual_block():
     残差ブロックの作成
     '''
 
+    from tensorflow.keras.layers import Activation, Add, BatchNormalization
+
     def f(x):
         sc = x
         x = conv(DN_FILTERS)(x)
@@ -54,6 +56,11 @@ def dual_network():
     if os.path.exists(os.path.join(MODEL_PATH, 'best.h5')):
         return
 
+    from tensorflow.keras.layers import Activation, BatchNormalization, Dense, GlobalAveragePooling2D, Input
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.regularizers import l2
+    from tensorflow.keras import backend as K
+
     # 入力層
     input = Input(shape=DN_INPUT_SHAPE)
 
@@ -6,16 +6,30 @@ import os
 
 # パッケージのインポート
 from game import State
-from pv_mcts import pv_mcts_action
-from tensorflow.keras.models import load_model
-from tensorflow.keras import backend as K
+from pv_mcts import pv_mcts_action, CachedModel, PV_CACHE_SIZE
+from model_registry import get_model
+from replay_buffer import next_generation
 from pathlib import Path
 from shutil import copy
 import numpy as np
+import math
 
 # パラメータの準備
 EN_GAME_COUNT = 10  # 1評価あたりのゲーム数（本家は400）
 EN_TEMPERATURE = 1.0  # ボルツマン分布の温度
+EN_PROCESS_NUM = 1  # 対戦を並行して行うプロセス数（1は1ゲームずつ）
+EN_POLL_INTERVAL = 1.0  # 並行して対戦する時にワーカーと推論サーバーの生存を確認する間隔（秒）
+
+# 逐次検定（SPRT）による早期打ち切り
+# EN_SPRTの時はEN_GAME_COUNTの代わりにEN_SPRT_GAME_COUNTゲーム（EN_SPRT_MIN_GAMES以上）を
+# 上限に対戦し、検定はEN_SPRT_MIN_GAMESゲームの結果が揃ってから始める
+EN_SPRT = False  # Trueの時は交代の可否が決まった時点で対戦を打ち切る
+EN_SPRT_GAME_COUNT = 400  # EN_SPRTの時の1評価あたりの最大ゲーム数
+EN_SPRT_SCORE0 = 0.5  # 帰無仮説の最新プレイヤーの期待ポイント
+EN_SPRT_SCORE1 = 0.6  # 対立仮説の最新プレイヤーの期待ポイント
+EN_SPRT_ALPHA = 0.05  # 第1種の誤り（弱いのに交代する）の確率
+EN_SPRT_BETA = 0.05  # 第2種の誤り（強いのに交代しない）の確率
+EN_SPRT_MIN_GAMES = 20  # 検定を始めるまでの最小ゲーム数（分散の推定のため）
 
 MODEL_PATH = os.environ.get('MODEL_PATH', './model')
 
@@ -23,6 +37,14 @@ BEST_PATH = os.path.join(MODEL_PATH, 'best.h5')
 LATEST_PATH = os.path.join(MODEL_PATH, 'latest.h5')
 
 
+def game_count():
+    '''
+    1評価あたりの（最大）ゲーム数
+    '''
+
+    return max(EN_SPRT_GAME_COUNT, EN_SPRT_MIN_GAMES) if EN_SPRT else EN_GAME_COUNT
+
+
 def first_player_point(ended_state):
     '''
     先手プレイヤーのポイント
@@ -60,55 +82,218 @@ def play(next_actions):
     return first_player_point(state)
 
 
-def update_best_player():
+def sprt_llr(points):
     '''
-    ベストプレイヤーの交代
+    対戦結果の対数尤度比（正規近似）
     '''
 
-    copy(LATEST_PATH, BEST_PATH)
-    print('Change BestPlayer')
+    n = len(points)
+    mean = sum(points) / n
+    var = sum((x - mean) ** 2 for x in points) / n
+    var = max(var, 1e-3)  # 全て同じ結果の時の0除算を避ける
+    s0, s1 = EN_SPRT_SCORE0, EN_SPRT_SCORE1
+    return n * (s1 - s0) * (2 * mean - s0 - s1) / (2 * var)
 
 
-def evaluate_network():
+def sprt_decision(points):
     '''
-    ネットワークの評価
+    SPRTの判定（True:交代, False:交代しない, None:継続）
+    '''
+
+    lower = math.log(EN_SPRT_BETA / (1 - EN_SPRT_ALPHA))
+    upper = math.log((1 - EN_SPRT_BETA) / EN_SPRT_ALPHA)
+    llr = sprt_llr(points)
+    if llr >= upper:
+        return True
+    if llr <= lower:
+        return False
+    return None
+
+
+def run_match(results):
+    '''
+    対戦結果 (ゲームの番号, ポイント) の集計（EN_SPRTの時は交代の可否が決まった時点で打ち切る）
+
+    並行して対戦すると結果は終わった順に届くので、検定は先手・後手が揃った
+    ゲームの組 (2k, 2k+1) のみで行う。
     '''
 
-   # 最新プレイヤーのモデルの読み込み
-    model0 = load_model(LATEST_PATH)
+    points = {}
+    pairs = []  # 揃った組のポイント
+    decision = None
+    for i, point in results:
+        points[i] = point
 
-    # ベストプレイヤーのモデルの読み込み
-    model1 = load_model(BEST_PATH)
+        # 出力
+        print('\rEvaluate {}/{}'.format(len(points), game_count()), end='')
+
+        # 先手・後手が揃うごとに検定
+        k = i - i % 2
+        if k in points and k + 1 in points:
+            pairs += [points[k], points[k + 1]]
+            if EN_SPRT and len(pairs) >= EN_SPRT_MIN_GAMES:
+                decision = sprt_decision(pairs)
+                if decision is not None:
+                    break
+    print('')
+
+    # 平均ポイントの計算
+    average_point = sum(points.values()) / len(points)
+    print('AveragePoint', average_point)
+    print('Games', len(points))
+    if decision is None:
+        decision = average_point > 0.5
+    return decision
+
+
+def update_best_player():
+    '''
+    ベストプレイヤーの交代
+    '''
+
+    # 読み込み中のプロセスが壊れたファイルを読まないよう一時ファイルから置き換える
+    copy(LATEST_PATH, BEST_PATH + '.tmp')
+    os.replace(BEST_PATH + '.tmp', BEST_PATH)
+    print('Change BestPlayer', next_generation())
+
+
+def play_games(model0, model1, game_indices):
+    '''
+    最新プレイヤーとベストプレイヤーの対戦（(ゲームの番号, 最新プレイヤーのポイント) を順に返す）
+    '''
 
     # PV MCTSで行動選択を行う関数の生成
     next_action0 = pv_mcts_action(model0, EN_TEMPERATURE)
     next_action1 = pv_mcts_action(model1, EN_TEMPERATURE)
     next_actions = (next_action0, next_action1)
 
-    # 複数回の対戦を繰り返す
-    total_point = 0
-    for i in range(EN_GAME_COUNT):
-        # 1ゲームの実行
+    for i in game_indices:
+        # 1ゲームの実行（偶数番目は最新プレイヤーが先手）
         if i % 2 == 0:
-            total_point += play(next_actions)
+            yield i, play(next_actions)
         else:
-            total_point += 1 - play(list(reversed(next_actions)))
+            yield i, 1 - play(list(reversed(next_actions)))
 
-        # 出力
-        print('\rEvaluate {}/{}'.format(i + 1, EN_GAME_COUNT), end='')
-    print('')
 
-    # 平均ポイントの計算
-    average_point = total_point / EN_GAME_COUNT
-    print('AveragePoint', average_point)
+def play_games_worker(client0, client1, game_indices, results, stop):
+    '''
+    対戦アリーナのワーカー（推論は推論サーバーで行う、stopが立ったら次のゲームを始めない）
+    '''
+
+    np.random.seed()  # マルチプロセス対応
+
+    # ゲーム間で共通の局面の推論結果をキャッシュ
+    if PV_CACHE_SIZE:
+        client0 = CachedModel(client0)
+        client1 = CachedModel(client1)
+
+    for result in play_games(client0, client1, game_indices):
+        results.put(result)
+        if stop.is_set():
+            break
+
+
+def evaluate_parallel(process_num=EN_PROCESS_NUM):
+    '''
+    複数プロセスで対戦を並行して行い、ベストプレイヤーを交代するかどうかを返す
+    '''
+
+    import multiprocessing as mp
+    from queue import Empty
+    from inference_server import InferenceServer
+
+    # TensorFlowを初期化済みのプロセスからforkしないようspawnで起動
+    ctx = mp.get_context('spawn')
+
+    # 最新プレイヤーとベストプレイヤーの推論サーバーを1つずつ起動
+    server0 = InferenceServer(LATEST_PATH, process_num, ctx=ctx)
+    server1 = InferenceServer(BEST_PATH, process_num, ctx=ctx)
+    server0.start()
+    server1.start()
+
+    # ゲームをワーカーに振り分けて対戦
+    results = ctx.Queue()
+    stop = ctx.Event()
+    workers = [ctx.Process(target=play_games_worker, args=(
+        server0.client(i), server1.client(i), range(i, game_count(), process_num),
+        results, stop))
+        for i in range(process_num)]
+    for worker in workers:
+        worker.start()
+
+    def arena_results():
+        # ワーカーや推論サーバーが落ちた時に待ち続けないよう、待つ間は生存を確認する
+        for _ in range(game_count()):
+            while True:
+                try:
+                    yield results.get(timeout=EN_POLL_INTERVAL)
+                    break
+                except Empty:
+                    pass
+                for worker in workers:
+                    if worker.exitcode not in (None, 0):
+                        raise RuntimeError('arena worker exited with code {}'.format(worker.exitcode))
+                if all(worker.exitcode == 0 for worker in workers):
+                    raise RuntimeError('arena workers exited before all games were played')
+                for server in (server0, server1):
+                    if not server.process.is_alive():
+                        raise RuntimeError('inference server exited with code {}'.format(
+                            server.process.exitcode))
+
+    try:
+        decision = run_match(arena_results())
+    except BaseException:
+        # 落ちた時は結果を待たずに全てのプロセスを止める
+        for process in workers + [server0.process, server1.process]:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        raise
+
+    # 打ち切った時は残りの対戦を始めないよう止め、対戦中のゲームの結果を読み捨てて終了を待つ
+    # （キューを使用中のプロセスをterminateするとキューが壊れることがある）
+    stop.set()
+    while any(worker.is_alive() for worker in workers):
+        try:
+            results.get(timeout=0.1)
+        except Empty:
+            pass
+    for worker in workers:
+        worker.join()
+    server0.stop()
+    server1.stop()
+
+    return decision
+
+
+def evaluate_network():
+    '''
+    ネットワークの評価
+    '''
+
+    if EN_PROCESS_NUM > 1:
+        # 複数プロセスで対戦
+        decision = evaluate_parallel(EN_PROCESS_NUM)
+    else:
+        # 最新プレイヤーのモデルの取得
+        model0 = get_model(LATEST_PATH)
+
+        # ベストプレイヤーのモデルの取得
+        model1 = get_model(BEST_PATH)
+
+        # ゲーム間で共通の局面の推論結果をキャッシュ
+        if PV_CACHE_SIZE:
+            model0 = CachedModel(model0)
+            model1 = CachedModel(model1)
 
-    # モデルの破棄
-    K.clear_session()
-    del model0
-    del model1
+        # 複数回の対戦を繰り返す
+        decision = run_match(play_games(
+            model0, model1, range(game_count())))
+        if PV_CACHE_SIZE:
+            print('EvalCache', model0.stats(), model1.stats())
 
     # ベストプレイヤーの交代
-    if average_point > 0.5:
+    if decision:
         update_best_player()
         return True
     else:
@@ -9,128 +9,305 @@ import math
 BOARD_SIZE = 8
 ALL_PIECES_NUM = BOARD_SIZE * BOARD_SIZE
 
+# ビットボード定数（マス i = x + y * BOARD_SIZE をビット i に対応させる）
+FULL_MASK = (1 << ALL_PIECES_NUM) - 1
+LEFT_COLUMN_MASK = sum(1 << (y * BOARD_SIZE)
+                       for y in range(BOARD_SIZE))
+RIGHT_COLUMN_MASK = LEFT_COLUMN_MASK << (BOARD_SIZE - 1)
+NOT_LEFT_MASK = FULL_MASK ^ LEFT_COLUMN_MASK  # x+1方向へのシフトで左端に回り込んだ石を除去
+NOT_RIGHT_MASK = FULL_MASK ^ RIGHT_COLUMN_MASK  # x-1方向へのシフトで右端に回り込んだ石を除去
+
+# 方向定数（シフト量, シフト後のマスク）
+DIRECTIONS = (
+    (1, NOT_LEFT_MASK),  # (1, 0)
+    (BOARD_SIZE + 1, NOT_LEFT_MASK),  # (1, 1)
+    (BOARD_SIZE, FULL_MASK),  # (0, 1)
+    (BOARD_SIZE - 1, NOT_RIGHT_MASK),  # (-1, 1)
+    (-1, NOT_RIGHT_MASK),  # (-1, 0)
+    (-BOARD_SIZE - 1, NOT_RIGHT_MASK),  # (-1, -1)
+    (-BOARD_SIZE, FULL_MASK),  # (0, -1)
+    (-BOARD_SIZE + 1, NOT_LEFT_MASK),  # (1, -1)
+)
+
+
+# シフトの向きごとの方向定数（シフト量, シフト後のマスク）
+LEFT_DIRECTIONS = tuple((n, mask) for n, mask in DIRECTIONS if n > 0)
+RIGHT_DIRECTIONS = tuple((-n, mask) for n, mask in DIRECTIONS if n < 0)
+
+
+def popcount(bits):
+    '''
+    立っているビットの数
+    '''
+
+    return bin(bits).count('1')
+
+
+def legal_bits(own, enemy):
+    '''
+    合法手のビットボードの取得
+    '''
+
+    # 自分の石から相手の石が連続する範囲を1, 2, 2マスずつ伸ばす（最大6マス）
+    moves = 0
+    for n, mask in LEFT_DIRECTIONS:
+        e = enemy & mask
+        t = (own << n) & e
+        t |= (t << n) & e
+        pair = e & (e << n)  # 相手の石が2つ並ぶ位置
+        t |= (t << (n + n)) & pair
+        t |= (t << (n + n)) & pair
+        moves |= (t << n) & mask
+    for n, mask in RIGHT_DIRECTIONS:
+        e = enemy & mask
+        t = (own >> n) & e
+        t |= (t >> n) & e
+        pair = e & (e >> n)  # 相手の石が2つ並ぶ位置
+        t |= (t >> (n + n)) & pair
+        t |= (t >> (n + n)) & pair
+        moves |= (t >> n) & mask
+    return moves & ~(own | enemy) & FULL_MASK
+
+
+def flip_bits(own, enemy, move):
+    '''
+    石を置いたときに反転する石のビットボードの取得
+    '''
+
+    flips = 0
+    for n, mask in LEFT_DIRECTIONS:
+        e = enemy & mask
+        f = 0
+        t = (move << n) & e
+        while t:
+            f |= t
+            t = (t << n) & e
+        if (f << n) & own & mask:
+            flips |= f
+    for n, mask in RIGHT_DIRECTIONS:
+        e = enemy & mask
+        f = 0
+        t = (move >> n) & e
+        while t:
+            f |= t
+            t = (t >> n) & e
+        if (f >> n) & own & mask:
+            flips |= f
+    return flips
+
+
+def playout_bits(own, enemy):
+    '''
+    ビットボードのまま終局までランダムに行動を選び、
+    開始局面の手番から見た価値を返す（1:勝ち, -1:負け, 0:引き分け）
+    '''
+
+    value = 1
+    while (own | enemy) != FULL_MASK:
+        moves = legal_bits(own, enemy)
+        if moves:
+            # 合法手からランダムに1つ選んで石を置く
+            k = random.randrange(popcount(moves))
+            for _ in range(k):
+                moves &= moves - 1
+            move = moves & -moves
+            flips = flip_bits(own, enemy, move)
+            own |= move | flips
+            enemy &= ~flips
+        elif not legal_bits(enemy, own):
+            break  # 双方とも打てない時は終局
+
+        # 手番の交代（打てない時はパス）
+        own, enemy = enemy, own
+        value = -value
+
+    own_count, enemy_count = popcount(own), popcount(enemy)
+    if own_count < enemy_count:
+        return -value
+    if own_count == enemy_count:
+        return 0
+    return value
+
+
+def bits_to_list(bits):
+    '''
+    ビットボードを0/1のリストに変換
+    '''
+
+    return [(bits >> i) & 1 for i in range(ALL_PIECES_NUM)]
+
+
+def list_to_bits(pieces):
+    '''
+    0/1のリストをビットボードに変換
+    '''
+
+    bits = 0
+    for i, piece in enumerate(pieces):
+        if piece == 1:
+            bits |= 1 << i
+    return bits
+
+
+def bits_to_actions(bits):
+    '''
+    ビットボードを行動のリストに変換
+    '''
+
+    actions = []
+    while bits:
+        low = bits & -bits
+        actions.append(low.bit_length() - 1)
+        bits ^= low
+    return actions
+
 
 class State:
     '''
     ゲーム状態
+
+    盤面は生成後に変更しない。合法手・石の数・勝敗は初回の問い合わせ時に
+    一度だけ計算してインスタンスに保持する。
     '''
 
+    # 探索木で大量に生成されるため__dict__を持たせない
+    __slots__ = ('own', 'enemy', 'depth', 'pass_end',
+                 '_legal', '_legal_actions', '_counts', '_done')
+
     # 初期化
     def __init__(self, pieces=None, enemy_pieces=None, depth=0):
-        # 方向定数
-        self.dxy = ((1, 0), (1, 1), (0, 1), (-1, 1),
-                    (-1, 0), (-1, -1), (0, -1), (1, -1))
+        # 石の配置（ビットボード）
+        if pieces == None or enemy_pieces == None:
+            # 石の初期配置
+            own = (1 << 27) | (1 << 36)
+            enemy = (1 << 28) | (1 << 35)
+        else:
+            own = list_to_bits(pieces)
+            enemy = list_to_bits(enemy_pieces)
+        self._setup(own, enemy, depth)
+
+    # ビットボードからの状態の設定
+    def _setup(self, own, enemy, depth, pass_end=False, legal=None):
+        self.own = own
+        self.enemy = enemy
+        self.depth = depth
 
         # 連続パスによる終了
-        self.pass_end = False
+        self.pass_end = pass_end
 
-        # 石の配置
-        self.pieces = pieces
-        self.enemy_pieces = enemy_pieces
-        self.depth = depth
+        # 計算済みの値のキャッシュ
+        self._legal = legal  # 合法手のビットボード
+        self._legal_actions = None  # 合法手のリスト
+        self._counts = None  # (自分の石の数, 相手の石の数)
+        self._done = None  # ゲーム終了かどうか
 
-        # 石の初期配置
-        if pieces == None or enemy_pieces == None:
-            self.pieces = [0] * ALL_PIECES_NUM
-            self.pieces[27] = self.pieces[36] = 1
-            self.enemy_pieces = [0] * ALL_PIECES_NUM
-            self.enemy_pieces[28] = self.enemy_pieces[35] = 1
+    # pickle化（ビットボードのみを保存する）
+    def __reduce__(self):
+        return restore_state, (self.own, self.enemy, self.depth, self.pass_end)
+
+    # 旧形式（__dict__に0/1のリストを持つ）のpickleからの復元
+    def __setstate__(self, state):
+        self._setup(list_to_bits(state['pieces']), list_to_bits(state['enemy_pieces']),
+                    state.get('depth', 0), state.get('pass_end', False))
+
+    # 自分の石の配置（0/1のリスト）
+    @property
+    def pieces(self):
+        return bits_to_list(self.own)
+
+    # 相手の石の配置（0/1のリスト）
+    @property
+    def enemy_pieces(self):
+        return bits_to_list(self.enemy)
 
     def piece_count(self, pieces):
         '''
         石の数の取得
         '''
+        if isinstance(pieces, int):
+            return popcount(pieces)
         count = 0
         for i in pieces:
             if i == 1:
                 count += 1
         return count
 
+    # 自分と相手の石の数
+    def piece_counts(self):
+        if self._counts is None:
+            self._counts = (popcount(self.own), popcount(self.enemy))
+        return self._counts
+
     # 負けかどうか
     def is_lose(self):
-        return self.is_done() and self.piece_count(self.pieces) < self.piece_count(self.enemy_pieces)
+        if not self.is_done():
+            return False
+        own_count, enemy_count = self.piece_counts()
+        return own_count < enemy_count
 
     # 引き分けかどうか
     def is_draw(self):
-        return self.is_done() and self.piece_count(self.pieces) == self.piece_count(self.enemy_pieces)
+        if not self.is_done():
+            return False
+        own_count, enemy_count = self.piece_counts()
+        return own_count == enemy_count
 
     # ゲーム終了かどうか
     def is_done(self):
-        return self.piece_count(self.pieces) + self.piece_count(self.enemy_pieces) == ALL_PIECES_NUM or self.pass_end
+        if self._done is None:
+            self._done = (self.own | self.enemy) == FULL_MASK or self.pass_end
+        return self._done
 
     # 次の状態の取得
     def next(self, action):
-        state = State(self.pieces.copy(),
-                      self.enemy_pieces.copy(), self.depth+1)
+        own, enemy = self.own, self.enemy
         if action != ALL_PIECES_NUM:
-            state.is_legal_action_xy(
-                action % BOARD_SIZE, int(action/BOARD_SIZE), True)
-        w = state.pieces
-        state.pieces = state.enemy_pieces
-        state.enemy_pieces = w
-
-        # 2回連続パス判定
-        if action == ALL_PIECES_NUM and state.legal_actions() == [ALL_PIECES_NUM]:
-            state.pass_end = True
+            move = 1 << int(action)
+            flips = flip_bits(own, enemy, move)
+            own |= move | flips
+            enemy &= ~flips
+
+        # 手番の交代
+        state = State.__new__(State)
+        if action == ALL_PIECES_NUM:
+            # 2回連続パス判定（計算した合法手は次の状態に引き継ぐ）
+            legal = legal_bits(enemy, own)
+            state._setup(enemy, own, self.depth + 1, not legal, legal)
+        else:
+            state._setup(enemy, own, self.depth + 1)
         return state
 
+    # 合法手のビットボードの取得
+    def legal_bits(self):
+        if self._legal is None:
+            self._legal = legal_bits(self.own, self.enemy)
+        return self._legal
+
     # 合法手のリストの取得
     def legal_actions(self):
-        actions = []
-        for j in range(0, BOARD_SIZE):
-            for i in range(0, BOARD_SIZE):
-                if self.is_legal_action_xy(i, j):
-                    actions.append(i+j*BOARD_SIZE)
-        if len(actions) == 0:
-            actions.append(ALL_PIECES_NUM)  # パス
-        return actions
+        if self._legal_actions is None:
+            actions = bits_to_actions(self.legal_bits())
+            if len(actions) == 0:
+                actions.append(ALL_PIECES_NUM)  # パス
+            self._legal_actions = actions
+        return list(self._legal_actions)
 
     # 任意のマスが合法手かどうか
-    def is_legal_action_xy(self, x, y, flip=False):
-        # 任意のマスの任意の方向が合法手かどうか
-        def is_legal_action_xy_dxy(x, y, dx, dy):
-            # １つ目 相手の石
-            x, y = x+dx, y+dy
-            if y < 0 or (BOARD_SIZE - 1) < y or x < 0 or (BOARD_SIZE - 1) < x or \
-                    self.enemy_pieces[x+y*BOARD_SIZE] != 1:
-                return False
-
-            # 2つ目以降
-            for j in range(BOARD_SIZE):
-                # 空
-                if y < 0 or (BOARD_SIZE - 1) < y or x < 0 or (BOARD_SIZE - 1) < x or \
-                        (self.enemy_pieces[x+y*BOARD_SIZE] == 0 and self.pieces[x+y*BOARD_SIZE] == 0):
-                    return False
-
-                # 自分の石
-                if self.pieces[x+y*BOARD_SIZE] == 1:
-                    # 反転
-                    if flip:
-                        for i in range(BOARD_SIZE):
-                            x, y = x-dx, y-dy
-                            if self.pieces[x+y*BOARD_SIZE] == 1:
-                                return True
-                            self.pieces[x+y*BOARD_SIZE] = 1
-                            self.enemy_pieces[x+y*BOARD_SIZE] = 0
-                    return True
-                # 相手の石
-                x, y = x+dx, y+dy
-            return False
+    def is_legal_action_xy(self, x, y):
+        return bool(self.legal_bits() >> (x + y * BOARD_SIZE) & 1)
 
-        # 空きなし
-        if self.enemy_pieces[x+y*BOARD_SIZE] == 1 or self.pieces[x+y*BOARD_SIZE] == 1:
-            return False
+    # 置換表のキー（石の配置・手番・パス状態）
+    def key(self):
+        return (self.own, self.enemy, self.depth % 2, self.pass_end)
 
-        # 石を置く
-        if flip:
-            self.pieces[x+y*BOARD_SIZE] = 1
+    # 同じ局面かどうか
+    def __eq__(self, other):
+        return isinstance(other, State) and \
+            (self.own, self.enemy, self.depth, self.pass_end) == \
+            (other.own, other.enemy, other.depth, other.pass_end)
 
-        # 任意の位置が合法手かどうか
-        flag = False
-        for dx, dy in self.dxy:
-            if is_legal_action_xy_dxy(x, y, dx, dy):
-                flag = True
-        return flag
+    def __hash__(self):
+        return hash((self.own, self.enemy, self.depth, self.pass_end))
 
     # 先手かどうか
     def is_first_player(self):
@@ -141,9 +318,9 @@ class State:
         ox = ('o', 'x') if self.is_first_player() else ('x', 'o')
         str = ''
         for i in range(ALL_PIECES_NUM):
-            if self.pieces[i] == 1:
+            if self.own >> i & 1:
                 str += ox[0]
-            elif self.enemy_pieces[i] == 1:
+            elif self.enemy >> i & 1:
                 str += ox[1]
             else:
                 str += '-'
@@ -152,6 +329,28 @@ class State:
         return str
 
 
+def restore_state(own, enemy, depth, pass_end):
+    '''
+    pickleからの状態の復元
+    '''
+
+    state = State.__new__(State)
+    state._setup(own, enemy, depth, pass_end)
+    return state
+
+
+def random_playout(state):
+    '''
+    Stateを生成せずに終局までランダムに行動を選び、stateの手番から見た価値を返す
+    '''
+
+    if state.is_done():
+        if state.is_lose():
+            return -1
+        return 0 if state.is_draw() else 1
+    return playout_bits(state.own, state.enemy)
+
+
 def random_action(state):
     '''
     ランダムで行動選択
@@ -9,21 +9,18 @@ import os
 # パッケージのインポート
 from game import State
 from pv_mcts import pv_mcts_action
-from tensorflow.keras.models import load_model
 from pathlib import Path
 from threading import Thread
 import tkinter as tk
-from test_game import mcs_action
+from baseline import mcs_action, close_pool
 
 
 BOARD_SIZE = 8
 ALL_PIECES_NUM = BOARD_SIZE * BOARD_SIZE
+HP_TIME_LIMIT = 3.0  # AIの1手あたりの思考時間の上限（秒）
 
 MODEL_PATH = os.environ.get('MODEL_PATH', './model')
 
-# ベストプレイヤーのモデルの読み込み
-model = load_model(os.path.join(MODEL_PATH, 'best.h5'))
-
 
 def get_coodicate(action):
     y = action // BOARD_SIZE
@@ -47,7 +44,8 @@ class GameUI(tk.Frame):
         self.prev_state = None
 
         # PV MCTSで行動選択を行う関数の生成
-        self.next_action = pv_mcts_action(model, 0.0)
+        self.next_action = pv_mcts_action(
+            model, 0.0, time_limit=HP_TIME_LIMIT, early_stop=True)
         # self.next_action = mcs_action
 
         # キャンバスの生成
@@ -166,7 +164,15 @@ if __name__ == '__main__':
     ai_is_first = not (len(sys.argv) > 1 and sys.argv[1] == 'second')
     print(sys.argv, ai_is_first)
 
+    # ベストプレイヤーのモデルの読み込み
+    # （ベースラインのワーカーはこのモジュールを読み込み直すのでモデルはここで読み込む）
+    from tensorflow.keras.models import load_model
+    model = load_model(os.path.join(MODEL_PATH, 'best.h5'))
+
     # ゲームUIの実行
-    f = GameUI(model=model, ai_is_first=ai_is_first)
-    f.pack()
-    f.mainloop()
+    try:
+        f = GameUI(model=model, ai_is_first=ai_is_first)
+        f.pack()
+        f.mainloop()
+    finally:
+        close_pool()
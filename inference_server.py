@@ -0,0 +1,113 @@
+# ====================
+# 推論サーバー
+# ====================
+
+# パッケージのインポート
+# （クライアントのプロセスでTensorFlowを読み込まないよう、Kerasはサーバーのプロセスでのみ読み込む）
+from queue import Empty
+import multiprocessing as mp
+import numpy as np
+import time
+
+# パラメータの準備
+IS_MAX_BATCH = 256  # 1回の推論でまとめる最大の局面数
+IS_MAX_WAIT = 0.005  # バッチが埋まるのを待つ最大時間（秒）
+
+
+def serve(model_path, request_queue, response_queues, max_batch, max_wait):
+    '''
+    推論サーバーのメインループ
+    '''
+
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras import backend as K
+
+    # モデルの読み込み（モデルを持つのはサーバープロセスのみ）
+    model = load_model(model_path)
+
+    running = True
+    while running:
+        # 最初のリクエストを待つ
+        request = request_queue.get()
+        if request is None:
+            break
+
+        # 最大バッチサイズか最大待ち時間に達するまでリクエストを集める
+        requests = [request]
+        rows = len(request[1])
+        deadline = time.time() + max_wait
+        while rows < max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = request_queue.get(timeout=timeout)
+            except Empty:
+                break
+            if request is None:
+                running = False
+                break
+            requests.append(request)
+            rows += len(request[1])
+
+        # まとめて推論
+        x = np.concatenate([xs for _, xs in requests])
+        y = model.predict(x, batch_size=len(x))
+
+        # 結果をクライアントごとに返す
+        i = 0
+        for client_id, xs in requests:
+            n = len(xs)
+            response_queues[client_id].put((y[0][i:i+n], y[1][i:i+n]))
+            i += n
+
+    # モデルの破棄
+    K.clear_session()
+    del model
+
+
+class InferenceClient:
+    '''
+    推論サーバーのクライアント（Kerasモデルと同じpredictを持つ）
+    '''
+
+    def __init__(self, client_id, request_queue, response_queue):
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    # 推論
+    def predict(self, x, batch_size=None):
+        self.request_queue.put((self.client_id, np.asarray(x)))
+        policies, values = self.response_queue.get()
+        return [policies, values]
+
+
+class InferenceServer:
+    '''
+    複数のゲームからの推論をまとめる推論サーバー
+
+    ctxを渡した時はそのコンテキストでキューとプロセスを作る（TensorFlowを初期化済みの
+    プロセスからはforkせずspawnのコンテキストを渡す）。クライアントも同じコンテキストの
+    プロセスで使う。
+    '''
+
+    def __init__(self, model_path, client_num, max_batch=IS_MAX_BATCH, max_wait=IS_MAX_WAIT,
+                 ctx=mp):
+        self.request_queue = ctx.Queue()
+        self.response_queues = [ctx.Queue() for _ in range(client_num)]
+        self.process = ctx.Process(target=serve, args=(
+            model_path, self.request_queue, self.response_queues, max_batch, max_wait), daemon=True)
+
+    # サーバーの開始
+    def start(self):
+        self.process.start()
+
+    # サーバーの停止
+    def stop(self):
+        self.request_queue.put(None)
+        self.process.join()
+
+    # クライアントの取得
+    def client(self, client_id):
+        return InferenceClient(client_id, self.request_queue, self.response_queues[client_id])
@@ -0,0 +1,82 @@
+# ====================
+# 読み込み済みモデルの管理
+# ====================
+
+# パッケージのインポート
+from numpy_network import NumpyModel
+import hashlib
+import os
+
+# 読み込み済みのモデル（キー -> [モデル, 読み込んだファイル, 更新時刻, ハッシュ]）
+_models = {}
+
+
+def file_hash(path):
+    '''
+    ファイルの内容のハッシュ
+    '''
+
+    h = hashlib.sha1()
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_model(path):
+    '''
+    モデルの読み込み（.npzはNumPyの推論モデル、それ以外はKerasのモデル）
+    '''
+
+    if path.endswith('.npz'):
+        return NumpyModel(path)
+    from tensorflow.keras.models import load_model
+    return load_model(path)
+
+
+def get_model(path, key=None, reload=False):
+    '''
+    モデルの取得
+
+    同じキー（省略時はパス）で読み込み済みのモデルがあり、ファイルの更新時刻か
+    内容が変わっていなければそのまま返す。変わっていた時は既存のモデルに重みのみを
+    読み込み直す。reloadの時はファイルが同じでも重みを読み込み直す（学習で重みを
+    書き換えるモデル用）。
+    '''
+
+    path = os.path.abspath(path)
+    key = key or path
+    mtime = os.path.getmtime(path)
+
+    # 初回は読み込み
+    entry = _models.get(key)
+    if entry is None:
+        model = load_model(path)
+        _models[key] = [model, path, mtime, file_hash(path)]
+        return model
+
+    model, loaded_path, loaded_mtime, loaded_hash = entry
+    if not reload and loaded_path == path and loaded_mtime == mtime:
+        return model
+
+    # 更新時刻のみ変わった時は内容を比較
+    digest = file_hash(path)
+    if not reload and loaded_path == path and loaded_hash == digest:
+        entry[2] = mtime
+        return model
+
+    # 既存のモデルに重みを読み込み直す（構造が違う時は読み込み直す）
+    try:
+        model.load_weights(path)
+    except ValueError:
+        model = load_model(path)
+    _models[key] = [model, path, mtime, digest]
+    return model
+
+
+def clear_models():
+    '''
+    読み込み済みのモデルの破棄
+    '''
+
+    _models.clear()
@@ -0,0 +1,131 @@
+# ====================
+# NumPyによるデュアルネットワークの推論
+# ====================
+
+# パッケージのインポート
+# （推論のみのプロセスでTensorFlowを読み込まないよう、Kerasは書き出し時のみ読み込む）
+import numpy as np
+import os
+
+# パラメータの準備
+MODEL_PATH = os.environ.get('MODEL_PATH', './model')
+BEST_PATH = os.path.join(MODEL_PATH, 'best.h5')
+NN_PATH = os.path.join(MODEL_PATH, 'best.npz')  # 書き出した重みのファイル
+
+
+def fold_batch_normalization(kernel, bn):
+    '''
+    畳み込みの重みにバッチ正規化を畳み込む（推論時の移動平均・分散を使う）
+    '''
+
+    gamma, beta, mean, variance = bn.get_weights()
+    scale = gamma / np.sqrt(variance + bn.epsilon)
+    return kernel * scale, beta - mean * scale
+
+
+def export_network(model, path=NN_PATH):
+    '''
+    Kerasのデュアルネットワークの重みを推論用に書き出し
+    '''
+
+    convs = [layer for layer in model.layers if type(layer).__name__ == 'Conv2D']
+    bns = [layer for layer in model.layers
+           if type(layer).__name__ == 'BatchNormalization']
+    denses = [layer for layer in model.layers if type(layer).__name__ == 'Dense']
+    assert len(convs) == len(bns) and len(convs) % 2 == 1
+
+    # 畳み込み層（バッチ正規化を畳み込み、(3*3*入力チャンネル数, カーネル数)に変形）
+    weights = {}
+    for i, (conv, bn) in enumerate(zip(convs, bns)):
+        kernel, bias = fold_batch_normalization(conv.get_weights()[0], bn)
+        weights['conv{}_w'.format(i)] = kernel.reshape(-1, kernel.shape[-1])
+        weights['conv{}_b'.format(i)] = bias
+
+    # ポリシー出力とバリュー出力
+    for dense in denses:
+        name = 'pi' if dense.name == 'pi' else 'v'
+        weights[name + '_w'], weights[name + '_b'] = dense.get_weights()
+
+    # 読み込み中のプロセスが壊れたファイルを読まないよう一時ファイルから置き換える
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, mode='wb') as f:
+        np.savez(f, **{k: v.astype(np.float32) for k, v in weights.items()})
+    os.replace(tmp, path)
+
+
+def update_network(h5_path=BEST_PATH, path=NN_PATH):
+    '''
+    Kerasのモデルの方が新しい時のみ重みを書き出し直す
+    '''
+
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(h5_path):
+        return
+    from tensorflow.keras.models import load_model
+    from tensorflow.keras import backend as K
+    model = load_model(h5_path)
+    export_network(model, path)
+    K.clear_session()
+    del model
+
+
+def conv3x3(x, w, b):
+    '''
+    3x3の畳み込み（padding='same'）
+    '''
+
+    # 9通りにずらした盤面をチャンネル方向に並べて1回の行列積にする
+    n, h, width, c = x.shape
+    padded = np.zeros((n, h + 2, width + 2, c), dtype=x.dtype)
+    padded[:, 1:-1, 1:-1] = x
+    cols = np.concatenate([padded[:, i:i+h, j:j+width]
+                           for i in range(3) for j in range(3)], axis=-1)
+    return cols @ w + b
+
+
+class NumpyModel:
+    '''
+    NumPyで推論するデュアルネットワーク（Kerasモデルと同じpredictを持つ）
+    '''
+
+    def __init__(self, path=NN_PATH):
+        self.load_weights(path)
+
+    # 重みの読み込み
+    def load_weights(self, path):
+        with np.load(path) as f:
+            weights = dict(f)
+        self.convs = [(weights['conv{}_w'.format(i)], weights['conv{}_b'.format(i)])
+                      for i in range(len(weights) // 2 - 2)]
+        self.pi = (weights['pi_w'], weights['pi_b'])
+        self.v = (weights['v_w'], weights['v_b'])
+
+    # 推論
+    def predict(self, x, batch_size=None):
+        x = np.asarray(x, dtype=np.float32)
+
+        # 畳み込み層
+        x = np.maximum(conv3x3(x, *self.convs[0]), 0)
+
+        # 残差ブロック
+        for i in range(1, len(self.convs), 2):
+            h = np.maximum(conv3x3(x, *self.convs[i]), 0)
+            h = conv3x3(h, *self.convs[i + 1])
+            x = np.maximum(h + x, 0)
+
+        # プーリング層
+        x = x.mean(axis=(1, 2))
+
+        # ポリシー出力（softmax）
+        p = x @ self.pi[0] + self.pi[1]
+        p = np.exp(p - p.max(axis=1, keepdims=True))
+        p /= p.sum(axis=1, keepdims=True)
+
+        # バリュー出力（tanh）
+        v = np.tanh(x @ self.v[0] + self.v[1])
+        return [p, v]
+
+
+# 動作確認
+if __name__ == '__main__':
+    update_network()
+    print('export', NN_PATH)
@@ -4,15 +4,32 @@
 
 # パッケージのインポート
 from game import State
-from dual_network import DN_INPUT_SHAPE
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
 from math import sqrt
-from tensorflow.keras.models import load_model
 from pathlib import Path
+from collections import OrderedDict
 import numpy as np
+import time
 
 # パラメータの準備
 # PV_EVALUATE_COUNT = 50 # 1推論あたりのシミュレーション回数（本家は1600）
 PV_EVALUATE_COUNT = 30  # 1推論あたりのシミュレーション回数（本家は1600）
+PV_BATCH_SIZE = 1  # 1回の推論でまとめて評価する葉ノードの数（1は逐次探索）
+PV_VIRTUAL_LOSS = 1  # バッチ探索中に選択済みのノードへ加える仮想損失
+PV_TABLE_SIZE = 100000  # 置換表に保持するノード数の上限（0は置換表なし）
+PV_CACHE_SIZE = 100000  # 推論結果のキャッシュに保持する局面数の上限（0はキャッシュなし）
+
+
+def states_to_boards(states):
+    '''
+    局面のリストを石の配置の配列 (局面数, 2, 8, 8) に変換
+    '''
+
+    a, b, c = DN_INPUT_SHAPE
+    bits = np.array([[state.own, state.enemy]
+                     for state in states], dtype=np.uint64)
+    boards = (bits[..., None] >> np.arange(a * b, dtype=np.uint64)) & 1
+    return boards.astype(np.uint8).reshape(len(states), c, a, b)
 
 
 def predict(model, state):
@@ -20,109 +37,317 @@ def predict(model, state):
     推論
     '''
 
-    # 推論のための入力データのシェイプの変換
-    a, b, c = DN_INPUT_SHAPE
-    x = np.array([state.pieces, state.enemy_pieces])
-    x = x.reshape(c, a, b).transpose(1, 2, 0).reshape(1, a, b, c)
+    return predict_batch(model, [state])[0]
+
+
+def predict_batch(model, states):
+    '''
+    複数局面のまとめた推論
+    '''
+
+    # 推論のための入力データのシェイプの変換
+    x = states_to_boards(states).transpose(0, 2, 3, 1)
 
     # 推論
-    y = model.predict(x, batch_size=1)
+    y = model.predict(x, batch_size=len(states))
 
-    # 方策の取得
-    policies = y[0][0][list(state.legal_actions())]  # 合法手のみ
-    policies /= sum(policies) if sum(policies) else 1  # 合計1の確率分布に変換
+    results = []
+    for i, state in enumerate(states):
+        # 方策の取得
+        policies = y[0][i][list(state.legal_actions())]  # 合法手のみ
+        policies /= sum(policies) if sum(policies) else 1  # 合計1の確率分布に変換
 
-    # 価値の取得
-    value = y[1][0][0]
-    return policies, value
+        # 価値の取得
+        value = y[1][i][0]
+        results.append((policies, value))
+    return results
 
 
-def nodes_to_scores(nodes):
+def transform_board(board, t):
     '''
-    ノードのリストを試行回数のリストに変換
+    盤面 (8, 8, ...) に8通りの回転・反転のうちt番目を適用
     '''
 
-    scores = []
-    for c in nodes:
-        scores.append(c.n)
-    return scores
+    board = np.rot90(board, t % 4, axes=(0, 1))
+    return np.flip(board, axis=1) if t >= 4 else board
 
 
-def pv_mcts_scores(model, state, temperature):
+def inverse_transform_board(board, t):
     '''
-    モンテカルロ木探索のスコアの取得
+    transform_boardの逆変換
+    '''
+
+    if t >= 4:
+        board = np.flip(board, axis=1)
+    return np.rot90(board, -(t % 4), axes=(0, 1))
+
+
+class CachedModel:
     '''
+    推論結果のLRUキャッシュ付きモデル（Kerasモデルと同じpredictを持つ）
 
-    # モンテカルロ木探索のノードの定義
-    class Node:
-        # ノードの初期化
-        def __init__(self, state, p):
-            self.state = state  # 状態
-            self.p = p  # 方策
-            self.w = 0  # 累計価値
-            self.n = 0  # 試行回数
-            self.child_nodes = None  # 子ノード群
-
-        # 局面の価値の計算
-        def evaluate(self):
-            # ゲーム終了時
-            if self.state.is_done():
-                # 勝敗結果で価値を取得
-                value = -1 if self.state.is_lose() else 0
-
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-                return value
-
-            # 子ノードが存在しない時
-            if not self.child_nodes:
-                # ニューラルネットワークの推論で方策と価値を取得
-                policies, value = predict(model, self.state)
-
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-
-                # 子ノードの展開
-                self.child_nodes = []
-                for action, policy in zip(self.state.legal_actions(), policies):
-                    self.child_nodes.append(
-                        Node(self.state.next(action), policy))
-                return value
-
-            # 子ノードが存在する時
+    盤面の回転・反転で同じになる局面は1つのキーにまとめ、方策（パスを除く）を
+    対応する向きに変換して返す。
+    '''
+
+    def __init__(self, model, size=PV_CACHE_SIZE):
+        self.model = model
+        self.size = size
+        self.cache = OrderedDict()  # キー -> (正規化した向きの方策, 価値)
+        self.hits = 0  # ヒット数
+        self.misses = 0  # ミス数
+        self.evictions = 0  # 追い出した数
+
+    # 8通りの向きのうちバイト列が最小のものをキーにする
+    def canonical(self, board):
+        keys = [transform_board(board, t).tobytes() for t in range(8)]
+        t = keys.index(min(keys))
+        return keys[t], t
+
+    # 推論
+    def predict(self, x, batch_size=None):
+        a, b, c = DN_INPUT_SHAPE
+        policies = np.zeros((len(x), DN_OUTPUT_SIZE), dtype=np.float32)
+        values = np.zeros((len(x), 1), dtype=np.float32)
+
+        # キャッシュにない局面のみまとめて推論
+        keys = [self.canonical(board) for board in x]
+        entries = {}  # キー -> (正規化した向きの方策, 価値)
+        misses = OrderedDict()  # キー -> 局面の番号
+        for i, (key, t) in enumerate(keys):
+            if key in entries or key in misses:
+                self.hits += 1
+            elif key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                entries[key] = self.cache[key]
             else:
-                # アーク評価値が最大の子ノードの評価で価値を取得
-                value = -self.next_child_node().evaluate()
-
-                # 累計価値と試行回数の更新
-                self.w += value
-                self.n += 1
-                return value
-
-        # アーク評価値が最大の子ノードを取得
-        def next_child_node(self):
-            # アーク評価値の計算
-            C_PUCT = 1.0
-            t = sum(nodes_to_scores(self.child_nodes))
-            pucb_values = []
-            for child_node in self.child_nodes:
-                pucb_values.append((-child_node.w / child_node.n if child_node.n else 0.0) +
-                                   C_PUCT * child_node.p * sqrt(t) / (1 + child_node.n))
-
-            # アーク評価値が最大の子ノードを返す
-            return self.child_nodes[np.argmax(pucb_values)]
+                self.misses += 1
+                misses[key] = i
+        if misses:
+            rows = list(misses.values())
+            y = self.model.predict(x[rows], batch_size=len(rows))
+            for j, i in enumerate(rows):
+                key, t = keys[i]
+                policy = y[0][j].copy()
+                policy[:a * b] = transform_board(
+                    policy[:a * b].reshape(a, b), t).reshape(-1)
+                entries[key] = self.cache[key] = (policy, y[1][j][0])
+                if len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+
+        # 正規化した向きから元の向きに戻す
+        for i, (key, t) in enumerate(keys):
+            policy, value = entries[key]
+            policies[i, :a * b] = inverse_transform_board(
+                policy[:a * b].reshape(a, b), t).reshape(-1)
+            policies[i, a * b:] = policy[a * b:]
+            values[i, 0] = value
+        return [policies, values]
+
+    # ヒット数・ミス数・追い出した数
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self.cache)}
+
+
+class Node:
+    '''
+    モンテカルロ木探索のノード
 
-    # 現在の局面のノードの作成
-    root_node = Node(state, 0)
+    子ノードへの辺の試行回数・累計価値・方策はNumPy配列で保持し、
+    アーク評価値の計算と逆伝播を配列演算で行う。
+    '''
 
-    # 複数回の評価の実行
-    for _ in range(PV_EVALUATE_COUNT):
-        root_node.evaluate()
+    # ノードの初期化
+    def __init__(self, state):
+        self.state = state  # 状態
+        self.w = 0  # 累計価値
+        self.n = 0  # 試行回数
+        self.child_nodes = None  # 子ノード群（初めて訪問するまではNone）
+        self.child_actions = None  # 子ノードへの行動
+        self.child_policies = None  # 子ノードへの方策
+        self.child_n = None  # 子ノードの試行回数
+        self.child_w = None  # 子ノードの累計価値（子ノードの手番から見た値）
+        self.child_total = 0  # 子ノードの試行回数の合計
+
+    # 局面の価値の計算（選択・展開・逆伝播を経路のスタックで繰り返し処理）
+    def evaluate(self, model, table=None):
+        # 展開済みのノードを辿って葉ノードを選択
+        path = []  # (ノード, 選んだ辺の番号)
+        node = self
+        while node.child_nodes:
+            i = node.next_child_index()
+            path.append((node, i))
+            node = node.child_node(i, table)
 
-    # 合法手の確率分布
-    scores = nodes_to_scores(root_node.child_nodes)
+        # ゲーム終了時
+        if node.state.is_done():
+            # 勝敗結果で価値を取得
+            value = -1 if node.state.is_lose() else 0
+
+        # 子ノードが存在しない時
+        else:
+            # ニューラルネットワークの推論で方策と価値を取得
+            policies, value = predict(model, node.state)
+
+            # 子ノードの展開
+            node.expand(policies, table)
+
+        # 累計価値と試行回数の更新
+        node.w += value
+        node.n += 1
+
+        # 経路を逆に辿って価値を逆伝播
+        for parent, i in reversed(path):
+            parent.child_n[i] += 1
+            parent.child_w[i] += value
+            parent.child_total += 1
+            value = -value
+            parent.w += value
+            parent.n += 1
+        return value
+
+    # 子ノードの展開（行動と方策のみ保持し、状態は初めて訪問する時に生成）
+    def expand(self, policies, table=None):
+        self.child_actions = self.state.legal_actions()
+        self.child_policies = np.asarray(policies, dtype=np.float64)
+        self.child_nodes = [None] * len(self.child_actions)
+        self.child_n = np.zeros(len(self.child_actions))
+        self.child_w = np.zeros(len(self.child_actions))
+
+    # i番目の子ノードの取得（置換表がある時は同一局面のノードを共有）
+    def child_node(self, i, table=None):
+        child_node = self.child_nodes[i]
+        if child_node is None:
+            state = self.state.next(self.child_actions[i])
+            child_node = table.node(state) if table is not None else Node(state)
+            self.child_nodes[i] = child_node
+        return child_node
+
+    # アーク評価値が最大の子ノードの番号を取得
+    def next_child_index(self):
+        # アーク評価値の計算
+        C_PUCT = 1.0
+        n = self.child_n
+        scores = self.child_policies * (C_PUCT * sqrt(self.child_total)) / (n + 1)
+        scores -= self.child_w / np.maximum(n, 1)  # 未訪問の子ノードの価値は0
+
+        # アーク評価値が最大の子ノードの番号を返す
+        return int(scores.argmax())
+
+
+class TranspositionTable:
+    '''
+    置換表（手順違いで同じ局面に至ったノードを共有する）
+
+    保持するノード数がsizeを超えた時は最も長く参照されていないノードを
+    置換表から取り除く。
+    '''
+
+    def __init__(self, size=PV_TABLE_SIZE):
+        self.size = size
+        self.nodes = OrderedDict()
+
+    # 局面のノードの取得（なければ作成して登録）
+    def node(self, state):
+        key = state.key()
+        node = self.nodes.get(key)
+        if node is not None:
+            self.nodes.move_to_end(key)
+            return node
+
+        node = Node(state)
+        self.nodes[key] = node
+        if len(self.nodes) > self.size:
+            self.nodes.popitem(last=False)
+        return node
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def select_leaves(root_node, count, table=None):
+    '''
+    仮想損失を加えながら推論待ちの葉ノードを最大count個選択
+    '''
+
+    paths = []  # 根ノードから葉ノードまでの経路（ノード, 選んだ辺の番号）
+    leaves = []  # 推論待ちの葉ノード
+    for _ in range(count):
+        # 展開済みのノードを辿って葉ノードを選択
+        node = root_node
+        path = []
+        while node.child_nodes:
+            i = node.next_child_index()
+            path.append((node, i))
+            node = node.child_node(i, table)
+        path.append((node, None))
+
+        # 推論待ちの葉ノードと衝突した時は次の推論に回す
+        if any(node is leaf for leaf in leaves):
+            break
+
+        # 仮想損失の付加（同じ経路が続けて選ばれないようにする）
+        for n, i in path:
+            n.w += PV_VIRTUAL_LOSS
+            n.n += 1
+            if i is not None:
+                n.child_w[i] += PV_VIRTUAL_LOSS
+                n.child_n[i] += 1
+                n.child_total += 1
+        paths.append(path)
+        if not node.state.is_done():
+            leaves.append(node)
+    return paths, leaves
+
+
+def backup(paths, leaves, results, table=None):
+    '''
+    葉ノードを展開し、仮想損失を取り除いて価値を逆伝播
+    '''
+
+    values = {}
+    for leaf, (policies, value) in zip(leaves, results):
+        leaf.expand(policies, table)
+        values[id(leaf)] = value
+
+    for path in paths:
+        leaf = path[-1][0]
+        if leaf.state.is_done():
+            # 勝敗結果で価値を取得
+            value = -1 if leaf.state.is_lose() else 0
+        else:
+            value = values[id(leaf)]
+        child_value = None
+        for n, i in reversed(path):
+            if i is not None:
+                n.child_w[i] += child_value - PV_VIRTUAL_LOSS
+            n.w += value - PV_VIRTUAL_LOSS
+            child_value = value
+            value = -value
+
+
+def evaluate_batch(model, root_node, count, table=None):
+    '''
+    葉ノードを複数集めてまとめて評価
+    '''
+
+    paths, leaves = select_leaves(root_node, count, table)
+
+    # ニューラルネットワークの推論で方策と価値を取得
+    results = predict_batch(model, [leaf.state for leaf in leaves]) if leaves else []
+    backup(paths, leaves, results, table)
+    return len(paths)
+
+
+def root_scores(root_node, temperature):
+    '''
+    根ノードの試行回数から合法手の確率分布を取得
+    '''
+
+    scores = root_node.child_n.tolist()
     if temperature == 0:  # 最大値のみ1
         action = np.argmax(scores)
         scores = np.zeros(len(scores))
@@ -132,14 +357,130 @@ def pv_mcts_scores(model, state, temperature):
     return scores
 
 
-def pv_mcts_action(model, temperature=0):
+def is_decided(root_node, remaining):
+    '''
+    残りのシミュレーションで最も試行回数の多い手が逆転しないかどうか
+    '''
+
+    n = root_node.child_n
+    if n is None:
+        return False
+    if len(n) == 1:
+        return True
+    second, best = np.partition(n, len(n) - 2)[-2:]
+    return best - second > remaining
+
+
+def search(model, root_node, count, batch_size=PV_BATCH_SIZE, table=None,
+           time_limit=None, early_stop=False):
+    '''
+    根ノードから最大count回のシミュレーションを実行
+
+    time_limit（秒）を超えた時、early_stopで最善手が逆転しなくなった時は
+    途中で終了する。
+    '''
+
+    start = time.time()
+    done = 0
+    while done < count:
+        if batch_size > 1:
+            done += evaluate_batch(model, root_node,
+                                   min(batch_size, count - done), table)
+        else:
+            root_node.evaluate(model, table)
+            done += 1
+
+        # 子ノードを1回も試行していない時は続ける
+        if (time_limit is None and not early_stop) or not root_node.child_total:
+            continue
+
+        # 時間切れ
+        remaining = count - done
+        if time_limit is not None:
+            elapsed = time.time() - start
+            if elapsed >= time_limit:
+                break
+
+            # 残り時間で実行できるシミュレーション回数の見積もり
+            remaining = min(remaining, int(
+                done / elapsed * (time_limit - elapsed)) if elapsed else remaining)
+
+        # 最善手が確定
+        if early_stop and is_decided(root_node, remaining):
+            break
+    return done
+
+
+def find_node(root_node, state):
+    '''
+    前回の根ノードとその子ノードから局面が一致するノードを探す
+    '''
+
+    if root_node is None:
+        return None
+    if root_node.state == state:
+        return root_node
+    for child_node in root_node.child_nodes or []:
+        if child_node is not None and child_node.state == state:
+            return child_node
+    return None
+
+
+def pv_mcts_scores(model, state, temperature, batch_size=PV_BATCH_SIZE):
+    '''
+    モンテカルロ木探索のスコアの取得
+    '''
+
+    # 現在の局面のノードの作成
+    table = TranspositionTable() if PV_TABLE_SIZE else None
+    root_node = table.node(state) if table is not None else Node(state)
+
+    # 複数回の評価の実行
+    search(model, root_node, PV_EVALUATE_COUNT, batch_size, table)
+
+    # 合法手の確率分布
+    return root_scores(root_node, temperature)
+
+
+def pv_mcts_action(model, temperature=0, batch_size=PV_BATCH_SIZE, reuse_tree=True,
+                   evaluate_count=PV_EVALUATE_COUNT, time_limit=None, early_stop=False):
     '''
     モンテカルロ木探索で行動選択
+
+    reuse_treeの時は選んだ手の部分木を次の呼び出しに持ち越し、
+    相手の手で到達した局面が木にあればその統計を引き継ぐ。
+    置換表も同じゲームの間は呼び出しをまたいで保持する。
+    1手あたりの探索はevaluate_count回の試行を上限とし、time_limit（秒）や
+    early_stop（最善手が逆転しなくなったら終了）でさらに打ち切る。
     '''
 
+    root_node = None
+    table = None
+
     def pv_mcts_action(state):
-        scores = pv_mcts_scores(model, state, temperature)
-        return np.random.choice(state.legal_actions(), p=scores)
+        nonlocal root_node, table
+
+        # 前回の探索木から現在の局面のノードを取得
+        node = find_node(root_node, state) if reuse_tree else None
+        if node is None:
+            # 新しいゲームの時は置換表を作り直す（前のゲームの統計を引き継がない）
+            if PV_TABLE_SIZE and reuse_tree and (
+                    table is None or root_node is None or state.depth <= root_node.state.depth):
+                table = TranspositionTable()
+            node = table.node(state) if table is not None else Node(state)
+
+        # 試行回数がevaluate_countに達するまで評価を追加
+        search(model, node, max(evaluate_count - node.n, 1),
+               batch_size, table, time_limit, early_stop)
+
+        # 行動の取得
+        legal_actions = state.legal_actions()
+        scores = root_scores(node, temperature)
+        action = np.random.choice(legal_actions, p=scores)
+
+        # 選んだ手の子ノードを次の根ノードとして保持
+        root_node = node.child_node(legal_actions.index(action), table)
+        return action
     return pv_mcts_action
 
 
@@ -154,6 +495,7 @@ def boltzman(xs, temperature):
 
 # 動作確認
 if __name__ == '__main__':
+    from tensorflow.keras.models import load_model
     MODEL_PATH = os.environ.get('MODEL_PATH', './model')
 
     # モデルの読み込み
@@ -0,0 +1,206 @@
+# ====================
+# 学習データのリプレイバッファ
+# ====================
+
+# 学習データのファイル（シャード）は保存時のベストプレイヤーの世代をファイル名に持つ
+# （例: 2020010112345_g0003.replay）。学習には新しい方から一定数の局面・世代のみを使い、
+# 範囲外になった古いシャードは削除し、同じ世代の小さなシャードは1つにまとめる。
+# セルフプレイが追記中のログ（.gamelog）も確定した局面をシャードとして読むが、削除・まとめはしない。
+
+# パッケージのインポート
+from replay_data import RD_EXT, RD_LOG_EXT, RD_MAGIC
+from replay_data import read_header, read_history, write_replay, log_size, rotate_log
+from pathlib import Path
+import numpy as np
+import re
+import os
+
+# パラメータの準備
+RB_WINDOW_SIZE = 500000  # 学習に使う最新の局面数（0は制限なし）
+RB_WINDOW_GENERATIONS = 0  # 学習に使う最新の世代数（0は制限なし）
+RB_EVICT = True  # Trueの時は範囲外になったシャードを削除する
+RB_COMPACT_COUNT = 8  # 同じ世代のシャードがこの数を超えたら1つにまとめる（0はまとめない）
+
+MODEL_PATH = os.environ.get('MODEL_PATH', './model')
+DATA_PATH = os.environ.get('DATA_PATH', './data')
+GENERATION_PATH = os.path.join(MODEL_PATH, 'best.generation')
+
+
+def read_generation():
+    '''
+    ベストプレイヤーの世代（交代するごとに1増える）
+    '''
+
+    if not os.path.exists(GENERATION_PATH):
+        return 0
+    with open(GENERATION_PATH) as f:
+        return int(f.read())
+
+
+def next_generation():
+    '''
+    ベストプレイヤーの世代を進める
+    '''
+
+    generation = read_generation() + 1
+    with open(GENERATION_PATH + '.tmp', mode='w') as f:
+        f.write(str(generation))
+    os.replace(GENERATION_PATH + '.tmp', GENERATION_PATH)
+    return generation
+
+
+def shard_generation(path):
+    '''
+    シャードの世代（世代のない旧形式のファイルは0）
+    '''
+
+    m = re.search(r'_g(\d+)', Path(path).name)
+    return int(m.group(1)) if m else 0
+
+
+def live_path(path):
+    '''
+    シャードの現在のパス（追記中だったログが列形式に置き換えられていたら置き換え先）
+    '''
+
+    path = Path(path)
+    if path.suffix == RD_LOG_EXT and not path.exists():
+        return path.with_suffix(RD_EXT)
+    return path
+
+
+def read_shard(path):
+    '''
+    シャードの読み込み（詰めた盤面, 方策, 価値）
+    '''
+
+    return read_history(live_path(path))
+
+
+def shard_size(path):
+    '''
+    シャードの局面数
+    '''
+
+    path = str(live_path(path))
+    if path.endswith(RD_EXT):
+        return read_header(path, RD_MAGIC)[0]
+    if path.endswith(RD_LOG_EXT):
+        return log_size(path)
+    return len(read_history(path)[2])
+
+
+def shard_paths():
+    '''
+    シャードのパス（世代と保存時刻の古い順）
+    '''
+
+    paths = list(Path(DATA_PATH).glob('*.history')) + \
+        list(Path(DATA_PATH).glob('*' + RD_EXT))
+
+    # 追記中のログ（列形式に置き換え済みで削除前のものと、確定した行がないものは除く）
+    for path in Path(DATA_PATH).glob('*' + RD_LOG_EXT):
+        if not path.with_suffix(RD_EXT).exists() and log_size(str(path)):
+            paths.append(path)
+    return sorted(paths, key=lambda p: (shard_generation(p), live_path(p).stat().st_mtime, p.name))
+
+
+def split_window(paths):
+    '''
+    シャードを学習に使う範囲 [(パス, 使う局面数)] と範囲外のパスに分ける
+    '''
+
+    window = []
+    size = 0
+    generations = set()
+    for path in reversed(paths):
+        generation = shard_generation(path)
+        if RB_WINDOW_GENERATIONS and generation not in generations and \
+                len(generations) >= RB_WINDOW_GENERATIONS:
+            break
+        if RB_WINDOW_SIZE and size >= RB_WINDOW_SIZE:
+            break
+        count = shard_size(path)
+        if RB_WINDOW_SIZE:
+            count = min(count, RB_WINDOW_SIZE - size)
+        window.append((path, count))
+        generations.add(generation)
+        size += count
+    window.reverse()
+    return window, paths[:len(paths) - len(window)]
+
+
+def compact(paths, compact_count=None):
+    '''
+    同じ世代のシャードがcompact_count（省略時はRB_COMPACT_COUNT）を超えたら1つにまとめる
+    （最新の世代は書き込み中なので除く）
+    '''
+
+    if compact_count is None:
+        compact_count = RB_COMPACT_COUNT
+
+    generations = {}
+    for path in paths:
+        if path.suffix == RD_LOG_EXT:
+            continue
+        generations.setdefault(shard_generation(path), []).append(path)
+    latest = max(generations) if generations else None
+    for generation, group in generations.items():
+        if generation == latest or not compact_count or len(group) <= compact_count:
+            continue
+
+        # 世代ごとに1つのファイルに書き込んでから元のシャードを削除
+        columns = [read_history(path) for path in group]
+        boards, policies, values = (np.concatenate(c) for c in zip(*columns))
+        path = os.path.join(DATA_PATH, 'compact_g{:04}{}'.format(generation, RD_EXT))
+        write_replay(path, boards, policies, values, packed=True)
+        for old_path in group:
+            if old_path != Path(path):
+                os.remove(str(old_path))
+        print('compact', len(group), 'shards ->', path)
+
+
+def update_buffer():
+    '''
+    範囲外のシャードの削除とシャードのまとめ
+    '''
+
+    window, old = split_window(shard_paths())
+    old = [path for path in old if path.suffix != RD_LOG_EXT]
+    if RB_EVICT:
+        for path in old:
+            os.remove(str(path))
+        if old:
+            print('evict', len(old), 'shards')
+    compact([path for path, _ in window])
+
+
+def recover_logs(pattern='*'):
+    '''
+    書き込み途中で止まったログを確定した行までの列形式のファイルに置き換える
+    '''
+
+    for path in Path(DATA_PATH).glob(pattern + RD_LOG_EXT):
+        print('recover', path, '->', rotate_log(str(path)))
+
+
+def window_shards():
+    '''
+    学習に使う範囲のシャード [(パス, 使う局面数)]（各シャードの末尾の局面を使う）
+    '''
+
+    return split_window(shard_paths())[0]
+
+
+def load_window(window=None):
+    '''
+    学習に使う範囲の学習データの読み込み（詰めた盤面, 方策, 価値）
+    '''
+
+    if window is None:
+        window = window_shards()
+    columns = []
+    for path, count in window:
+        print('loading... ', path)
+        columns.append([c[len(c) - count:] for c in read_shard(path)])
+    return tuple(np.concatenate(c) for c in zip(*columns))
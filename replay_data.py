@@ -0,0 +1,255 @@
+# ====================
+# 学習データの列形式ファイル
+# ====================
+
+# ファイルの構成（ヘッダ以外は局面数ぶんの列を順に並べる）
+#   ヘッダ    : マジック(8バイト), バージョン, 局面数, 方策のサイズ (uint32 x 3) を32バイトに詰める
+#   盤面      : uint8 (局面数, 2, 8)   自分と相手の石の配置を64ビットずつ詰めたもの
+#   方策      : float16 (局面数, 方策のサイズ)
+#   価値      : int8 (局面数,)
+#
+# セルフプレイ中のデータは追記専用のログ（.gamelog）に1局面1行で書き足し、
+# 書き込みが確定した位置を小さな索引ファイル（.gamelog.index）に記録する。
+# 読み込み側は索引までの行のみを読むので、書き込み途中に落ちても壊れた行は読まない。
+#   ログ      : ヘッダ（列形式と同じ構成、局面数は0）+ 行（詰めた盤面, 方策, 価値）の並び
+#   索引      : uint64 追記ごと（1ゲームか同時に進めたゲームの組）の確定した末尾の位置
+
+# パッケージのインポート
+import numpy as np
+import pickle
+import os
+
+# パラメータの準備
+RD_EXT = '.replay'  # 列形式の学習データの拡張子
+RD_MAGIC = b'RVREPLAY'
+RD_VERSION = 1
+RD_HEADER_SIZE = 32
+RD_BOARD_BYTES = 8  # 64マスを詰めた1枚分のバイト数
+RD_LOG_EXT = '.gamelog'  # 追記中の学習データの拡張子
+RD_LOG_MAGIC = b'RVGAMLOG'
+RD_INDEX_EXT = '.index'  # ログの索引の拡張子
+
+
+def pack_boards(boards):
+    '''
+    石の配置 (局面数, 2, 64) を (局面数, 2, 8) のビット列に詰める
+    '''
+
+    boards = np.asarray(boards, dtype=np.uint8).reshape(len(boards), 2, -1)
+    return np.packbits(boards, axis=-1, bitorder='little')
+
+
+def unpack_boards(packed):
+    '''
+    pack_boardsの逆変換（(局面数, 2, 8, 8) の配列を返す）
+    '''
+
+    boards = np.unpackbits(np.asarray(packed), axis=-1, bitorder='little')
+    return boards.reshape(len(boards), 2, 8, 8)
+
+
+def history_to_columns(history):
+    '''
+    [[石の配置, 相手の石の配置], 方策, 価値] のリストを列に変換
+    '''
+
+    boards = np.array([h[0] for h in history], dtype=np.uint8)
+    policies = np.array([h[1] for h in history], dtype=np.float16)
+    values = np.array([h[2] for h in history], dtype=np.int8)
+    return boards, policies, values
+
+
+def make_header(magic, count, policy_size):
+    '''
+    ファイルのヘッダ
+    '''
+
+    header = np.zeros(RD_HEADER_SIZE, dtype=np.uint8)
+    header[:len(magic)] = np.frombuffer(magic, dtype=np.uint8)
+    header[len(magic):len(magic) + 12] = np.array(
+        [RD_VERSION, count, policy_size], dtype='<u4').view(np.uint8)
+    return header
+
+
+def read_header(path, magic):
+    '''
+    ファイルのヘッダの読み込み（局面数, 方策のサイズ）
+    '''
+
+    header = np.fromfile(path, dtype=np.uint8, count=RD_HEADER_SIZE)
+    if header[:len(magic)].tobytes() != magic:
+        raise ValueError('not a replay file: {}'.format(path))
+    version, count, policy_size = header[len(magic):len(magic) + 12].view('<u4')
+    if version != RD_VERSION:
+        raise ValueError('unsupported replay version {}: {}'.format(version, path))
+    return int(count), int(policy_size)
+
+
+def write_replay(path, boards, policies, values, packed=False):
+    '''
+    列形式の学習データの保存（packedでない時のboardsは詰める前の石の配置）
+    '''
+
+    packed = np.asarray(boards, dtype=np.uint8) if packed else pack_boards(boards)
+    policies = np.asarray(policies, dtype=np.float16)
+    values = np.asarray(values, dtype=np.int8)
+    header = make_header(RD_MAGIC, len(values), policies.shape[1])
+
+    # 書き込み途中のファイルを読まれないよう一時ファイルから置き換える
+    with open(path + '.tmp', mode='wb') as f:
+        for column in (header, packed, policies, values):
+            f.write(column.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def read_replay(path):
+    '''
+    列形式の学習データをメモリマップで読み込み（詰めた盤面, 方策, 価値）
+    '''
+
+    count, policy_size = read_header(path, RD_MAGIC)
+
+    columns = []
+    offset = RD_HEADER_SIZE
+    for dtype, shape in ((np.uint8, (count, 2, RD_BOARD_BYTES)),
+                         (np.float16, (count, policy_size)),
+                         (np.int8, (count,))):
+        if count:
+            columns.append(np.memmap(path, dtype=dtype, mode='r',
+                                     offset=offset, shape=shape))
+        else:
+            columns.append(np.zeros(shape, dtype=dtype))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return tuple(columns)
+
+
+def read_history(path):
+    '''
+    学習データの読み込み（旧形式のpickleも列に変換して返す）
+    '''
+
+    path = str(path)
+    if path.endswith(RD_EXT):
+        return read_replay(path)
+    if path.endswith(RD_LOG_EXT):
+        return read_log(path)
+    with open(path, mode='rb') as f:
+        boards, policies, values = history_to_columns(pickle.load(f))
+    return pack_boards(boards), policies, values
+
+
+def row_dtype(policy_size):
+    '''
+    ログの1行（1局面）の型
+    '''
+
+    return np.dtype([('board', np.uint8, (2, RD_BOARD_BYTES)),
+                     ('policy', '<f2', (policy_size,)), ('value', np.int8)])
+
+
+def read_index(path):
+    '''
+    ログの索引の読み込み（追記ごとの確定した末尾の位置）
+    '''
+
+    if not os.path.exists(path + RD_INDEX_EXT):
+        return np.zeros(0, dtype='<u8')
+    return np.fromfile(path + RD_INDEX_EXT, dtype='<u8')
+
+
+def read_log_header(path):
+    '''
+    ログのヘッダの読み込み（方策のサイズ、ヘッダを書く前に落ちたログはNone）
+    '''
+
+    if not os.path.exists(path) or os.path.getsize(path) < RD_HEADER_SIZE:
+        return None
+    return read_header(path, RD_LOG_MAGIC)[1]
+
+
+def log_size(path):
+    '''
+    ログの確定した局面数
+    '''
+
+    policy_size = read_log_header(path)
+    if policy_size is None:
+        return 0
+    index = read_index(path)
+    end = int(index[-1]) if len(index) else RD_HEADER_SIZE
+    return (end - RD_HEADER_SIZE) // row_dtype(policy_size).itemsize
+
+
+def read_log(path):
+    '''
+    ログの確定した行をメモリマップで読み込み（詰めた盤面, 方策, 価値）
+    '''
+
+    policy_size = read_log_header(path)
+    count = log_size(path)
+    if policy_size is None:
+        # ヘッダのないログは空のログとして扱う
+        return (np.zeros((0, 2, RD_BOARD_BYTES), dtype=np.uint8),
+                np.zeros((0, 0), dtype=np.float16), np.zeros(0, dtype=np.int8))
+    if count:
+        rows = np.memmap(path, dtype=row_dtype(policy_size), mode='r',
+                         offset=RD_HEADER_SIZE, shape=(count,))
+    else:
+        rows = np.zeros(0, dtype=row_dtype(policy_size))
+    return rows['board'], rows['policy'], rows['value']
+
+
+def rotate_log(path):
+    '''
+    ログの確定した行を列形式のファイルに書き出し、ログと索引を削除
+    （書き込み途中に落ちたログの復旧にも使う。確定した行がない時は削除のみ）
+    '''
+
+    replay_path = path[:-len(RD_LOG_EXT)] + RD_EXT
+    boards, policies, values = read_log(path)
+    if len(values):
+        write_replay(replay_path, boards, policies, values, packed=True)
+    for p in (path + RD_INDEX_EXT, path):
+        if os.path.exists(p):
+            os.remove(p)
+    return replay_path if len(values) else None
+
+
+class ReplayWriter:
+    '''
+    ゲームごとに学習データをログに追記するライター
+
+    追記した行をディスクに書き出してから索引を置き換えるので、索引にある行は常に読める。
+    closeでログを列形式のファイル（path）に置き換える。
+    '''
+
+    def __init__(self, path, policy_size):
+        self.path = path[:-len(RD_EXT)] + RD_LOG_EXT
+        self.dtype = row_dtype(policy_size)
+        self.index = []  # 追記ごとの確定した末尾の位置
+        self.f = open(self.path, mode='wb')
+        self.f.write(make_header(RD_LOG_MAGIC, 0, policy_size).tobytes())
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    # 1ゲーム分の学習データの追記
+    def append(self, history):
+        boards, policies, values = history_to_columns(history)
+        rows = np.zeros(len(values), dtype=self.dtype)
+        rows['board'] = pack_boards(boards)
+        rows['policy'] = policies
+        rows['value'] = values
+        self.f.write(rows.tobytes())
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+        # 索引は一時ファイルから置き換える
+        self.index.append(self.f.tell())
+        with open(self.path + RD_INDEX_EXT + '.tmp', mode='wb') as f:
+            f.write(np.array(self.index, dtype='<u8').tobytes())
+        os.replace(self.path + RD_INDEX_EXT + '.tmp', self.path + RD_INDEX_EXT)
+
+    # ログを列形式のファイルに置き換える
+    def close(self):
+        self.f.close()
+        return rotate_log(self.path)
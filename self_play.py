@@ -4,11 +4,13 @@
 
 # パッケージのインポート
 from game import State
-from pv_mcts import pv_mcts_scores
+from pv_mcts import pv_mcts_scores, Node, PV_EVALUATE_COUNT, PV_BATCH_SIZE, PV_CACHE_SIZE
+from pv_mcts import CachedModel
+from pv_mcts import select_leaves, backup, predict_batch, root_scores, states_to_boards
 from dual_network import DN_OUTPUT_SIZE
 from datetime import datetime
-from tensorflow.keras.models import load_model
-from tensorflow.keras import backend as K
+from model_registry import get_model
+from numpy_network import update_network, NN_PATH
 from pathlib import Path
 import numpy as np
 import pickle
@@ -16,13 +18,18 @@ import os
 import sys
 import time
 import random
-from train_network import load_data
+from replay_buffer import read_generation, shard_paths, split_window, compact, update_buffer
+from replay_buffer import recover_logs
+from replay_data import RD_EXT, ReplayWriter
 
 # パラメータの準備
 # SP_GAME_COUNT = 500  # セルフプレイを行うゲーム数（本家は25000）
 SP_GAME_COUNT = 10  # 500だと2回回せない説
 
 SP_TEMPERATURE = 1.0  # ボルツマン分布の温度パラメータ
+SP_LOCKSTEP_COUNT = 1  # 1プロセスで同時に進めるゲーム数（1は1ゲームずつ）
+SP_NUMPY = False  # TrueはKerasの代わりに書き出した重みとNumPyで推論する
+SP_SHARD_GAMES = 0  # 学習データのファイルを切り替えるゲーム数（0は切り替えない）
 
 MODEL_PATH = os.environ.get('MODEL_PATH', './model')
 DATA_PATH = os.environ.get('DATA_PATH', './data')
@@ -41,17 +48,25 @@ def first_player_value(ended_state):
     return 0
 
 
-def write_data(history, suffix=""):
+def data_path(generation, worker=0):
     '''
-    学習データの保存
+    学習データの保存先のパス（ファイル名に学習データを作ったベストプレイヤーの世代と
+    書き込んだワーカーの番号を付ける）
     '''
 
     now = datetime.now()
     os.makedirs(DATA_PATH, exist_ok=True)  # フォルダがない時は生成
-    path = os.path.join(DATA_PATH, '{:04}{:02}{:02}{:02}{:02}{:02}{}.history'.format(
-        now.year, now.month, now.day, now.hour, now.minute, now.microsecond, suffix))
-    with open(path, mode='wb') as f:
-        pickle.dump(history, f)
+    return os.path.join(DATA_PATH, '{:04}{:02}{:02}{:02}{:02}{:02}_g{:04}_w{:02}{}'.format(
+        now.year, now.month, now.day, now.hour, now.minute, now.microsecond,
+        generation, worker, RD_EXT))
+
+
+def worker_logs(worker=0):
+    '''
+    ワーカーの書き込み中のログのパターン
+    '''
+
+    return '*_w{:02}'.format(worker)
 
 
 def load_state():
@@ -79,8 +94,24 @@ def save_state(state):
 
 
 def concat_hisotry():
-    data = load_data(all_history=True)
-    write_data(data, suffix="_concated")
+    '''
+    学習データのシャードを世代ごとに1つにまとめる（範囲外のシャードは削除）
+    '''
+
+    update_buffer()
+    compact([path for path, _ in split_window(shard_paths())[0]], compact_count=1)
+
+
+def best_model():
+    '''
+    ベストプレイヤーのモデルの取得（更新されていなければ読み込み済みのものを使う）
+    '''
+
+    if SP_NUMPY:
+        # ベストプレイヤーが交代していたら重みを書き出し直す
+        update_network(BEST_PATH, NN_PATH)
+        return get_model(NN_PATH)
+    return get_model(BEST_PATH)
 
 
 def play(model, using_saved_state=False, saving_ontheway_state=False):
@@ -141,55 +172,181 @@ def play(model, using_saved_state=False, saving_ontheway_state=False):
     return history
 
 
-def self_play(x=None):
+def play_lockstep(model, game_count, batch_size=PV_BATCH_SIZE):
     '''
-    セルフプレイ
+    複数ゲームを同時に1手ずつ進める実行（全ゲームの葉ノードをまとめて推論）
     '''
-    print("start: ", x)
-    np.random.seed()  # マルチプロセス対応
 
     # 学習データ
+    histories = [[] for _ in range(game_count)]
+
+    # 状態の生成
+    states = [State() for _ in range(game_count)]
+    playing = list(range(game_count))
+
+    starttime = time.time()
+    while playing:
+        # 全ゲームの局面を (ゲーム数, 2, 8, 8) の配列で保持
+        boards = states_to_boards([states[g] for g in playing])
+
+        # 全ゲームの探索を同時に進める
+        roots = [Node(states[g]) for g in playing]
+        counts = [0] * len(playing)
+        while min(counts) < PV_EVALUATE_COUNT:
+            selections = []
+            leaves = []
+            for i, root_node in enumerate(roots):
+                if counts[i] >= PV_EVALUATE_COUNT:
+                    continue
+                paths, game_leaves = select_leaves(
+                    root_node, min(batch_size, PV_EVALUATE_COUNT - counts[i]))
+                counts[i] += len(paths)
+                selections.append((paths, game_leaves))
+                leaves.extend(game_leaves)
+
+            # 全ゲームの葉ノードを1回の推論で評価
+            results = predict_batch(
+                model, [leaf.state for leaf in leaves]) if leaves else []
+            i = 0
+            for paths, game_leaves in selections:
+                backup(paths, game_leaves, results[i:i+len(game_leaves)])
+                i += len(game_leaves)
+
+        # 学習データに状態と方策を追加して1手進める
+        for i, g in enumerate(playing):
+            state = states[g]
+            scores = root_scores(roots[i], SP_TEMPERATURE)
+            policies = np.zeros(DN_OUTPUT_SIZE)
+            policies[state.legal_actions()] = scores
+            histories[g].append(
+                [boards[i].reshape(2, -1).tolist(), policies.tolist(), None])
+            action = np.random.choice(state.legal_actions(), p=scores)
+            states[g] = state.next(action)
+
+        # 終了したゲームを除外
+        playing = [g for g in playing if not states[g].is_done()]
+
+    print('elapsed time', time.time() - starttime)
+
+    # 学習データに価値を追加
     history = []
+    for state, h in zip(states, histories):
+        value = first_player_value(state)
+        for i in range(len(h)):
+            h[i][2] = value
+            value = -value
+        history.extend(h)
+    return history
 
-    # ベストプレイヤーのモデルの読み込み
-    model = load_model(BEST_PATH)
+
+def self_play(x=None, model=None):
+    '''
+    セルフプレイ（modelを渡した時はそのモデルで推論する）
+    '''
+    print("start: ", x)
+    np.random.seed()  # マルチプロセス対応
+    worker = x or 0
+
+    # 前回途中で止まった時のログを確定したゲームまで保存
+    recover_logs(worker_logs(worker))
+
+    # ベストプレイヤーのモデルの取得（学習データには取得時の世代を記録する）
+    generation = read_generation()
+    if model is None:
+        model = best_model()
+
+    # ゲーム間で共通の局面の推論結果をキャッシュ
+    if PV_CACHE_SIZE:
+        model = CachedModel(model)
+
+    # 学習データはゲームが終わるごとにログに追記する
+    writer = ReplayWriter(data_path(generation, worker), DN_OUTPUT_SIZE)
 
     # 複数回のゲームの実行
-    for i in range(SP_GAME_COUNT):
-        # 1ゲームの実行
-        h = play(model)
-        history.extend(h)
+    i = 0
+    shard_start = 0  # 今のログに書き始めた時のゲーム数
+    while i < SP_GAME_COUNT:
+        if SP_LOCKSTEP_COUNT > 1:
+            # 複数ゲームを同時に実行
+            game_count = min(SP_LOCKSTEP_COUNT, SP_GAME_COUNT - i)
+            h = play_lockstep(model, game_count)
+        else:
+            # 1ゲームの実行
+            game_count = 1
+            h = play(model)
+        writer.append(h)
+        i += game_count
+
+        # SP_SHARD_GAMESゲームごとに列形式のファイルに置き換えて新しいログに切り替える
+        if SP_SHARD_GAMES and i - shard_start >= SP_SHARD_GAMES and i < SP_GAME_COUNT:
+            writer.close()
+            writer = ReplayWriter(data_path(generation, worker), DN_OUTPUT_SIZE)
+            shard_start = i
 
         # 出力
-        print('\rSelfPlay {}/{}'.format(i+1, SP_GAME_COUNT), end='')
+        print('\rSelfPlay {}/{}'.format(i, SP_GAME_COUNT), end='')
     print('')
 
+    if PV_CACHE_SIZE:
+        print('EvalCache', model.stats())
+
     # 学習データの保存
-    write_data(history)
+    writer.close()
+
 
-    # モデルの破棄
-    K.clear_session()
-    del model
+_pools = {}
 
 
 def do_multi(f=self_play, process_num=2):
-    import random
-    import os
+    '''
+    マルチプロセスのセルフプレイ（プールは使い回し、各プロセスのモデルを保持する）
+    '''
+
     import multiprocessing as mp
-    from queue import Empty
-    import math
-    import time
 
-    p = mp.Pool(process_num)
+    # NumPyで推論する時は各プロセスが書き出さないよう先に書き出す
+    if SP_NUMPY:
+        update_network(BEST_PATH, NN_PATH)
+
+    # Kerasを読み込み済みのプロセスからforkしないようspawnで起動
+    p = _pools.get(process_num)
+    if p is None:
+        p = _pools[process_num] = mp.get_context('spawn').Pool(process_num)
 
     y = range(process_num)
 
     results = p.map(f, y)
 
 
+def do_multi_server(process_num=2):
+    '''
+    推論サーバーを共有したマルチプロセスのセルフプレイ
+    '''
+
+    import multiprocessing as mp
+    from inference_server import InferenceServer
+
+    # TensorFlowを初期化済みのプロセスからforkしないようspawnで起動
+    ctx = mp.get_context('spawn')
+
+    # モデルは推論サーバーのみが持ち、各プロセスの推論をまとめて行う
+    server = InferenceServer(BEST_PATH, process_num, ctx=ctx)
+    server.start()
+
+    workers = [ctx.Process(target=self_play, args=(i, server.client(i)))
+               for i in range(process_num)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    server.stop()
+
+
 # 動作確認
 if __name__ == '__main__':
     is_multi = len(sys.argv) > 1 and sys.argv[1] == 'multi'
+    is_server = len(sys.argv) > 1 and sys.argv[1] == 'server'
 
     for n in range(100):
 
@@ -198,5 +355,9 @@ if __name__ == '__main__':
             process_num = 8
             print("process: ", process_num)
             do_multi(self_play, process_num=process_num)
+        elif is_server:
+            process_num = 8
+            print("process: ", process_num)
+            do_multi_server(process_num=process_num)
         else:
             self_play()
@@ -3,10 +3,8 @@
 # ====================
 
 # パッケージのインポート
-from dual_network import dual_network
-from self_play import self_play
-from train_network import train_network
-from evaluate_network import evaluate_network
+# （spawnで起動した子プロセスがこのモジュールを読み込み直す時にTensorFlowを読み込まないよう、
+# 学習サイクルの各部は実行時に読み込む）
 import time
 
 
@@ -20,16 +18,22 @@ def timeit(method):
     return timed
 
 
-# デュアルネットワークの作成
-dual_network()
+if __name__ == '__main__':
+    from dual_network import dual_network
+    from self_play import self_play
+    from train_network import train_network
+    from evaluate_network import evaluate_network
 
-for i in range(10):
-    print('Train', i, '====================')
-    # セルフプレイ部
-    timeit(self_play)()
+    # デュアルネットワークの作成
+    dual_network()
 
-    # # パラメータ更新部
-    timeit(train_network)(all_history=True)
+    for i in range(10):
+        print('Train', i, '====================')
+        # セルフプレイ部
+        timeit(self_play)()
 
-    # 新パラメータ評価部
-    timeit(evaluate_network)()
+        # # パラメータ更新部
+        timeit(train_network)(all_history=True)
+
+        # 新パラメータ評価部
+        timeit(evaluate_network)()
@@ -4,16 +4,22 @@
 
 # パッケージのインポート
 import os
-from dual_network import DN_INPUT_SHAPE, BOARD_SIZE
+from dual_network import DN_INPUT_SHAPE, DN_OUTPUT_SIZE
 from tensorflow.keras.callbacks import LearningRateScheduler, LambdaCallback
-from tensorflow.keras.models import load_model
-from tensorflow.keras import backend as K
-from pathlib import Path
+from model_registry import get_model
+from pv_mcts import transform_board
+from replay_data import unpack_boards
+from replay_buffer import shard_paths, shard_size, read_shard, update_buffer, window_shards, load_window
 import numpy as np
-import pickle
+import random
 
 # パラメータの準備
 RN_EPOCHS = 100  # 学習回数
+RN_BATCH_SIZE = 128  # バッチサイズ
+RN_STREAMING = True  # Trueの時は学習データを全て読み込まずにtf.dataで少しずつ読み込む
+RN_SHUFFLE_BUFFER = 100000  # 読み込みながらシャッフルするバッファの局面数
+RN_CHUNK_SIZE = 4096  # シャードから1回に読み込む局面数
+RN_AUGMENT = True  # Trueの時は読み込んだ局面に8通りの回転・反転からランダムに1つを適用する
 
 MODEL_PATH = os.environ.get('MODEL_PATH', './model')
 DATA_PATH = os.environ.get('DATA_PATH', './data')
@@ -22,22 +28,98 @@ BEST_PATH = os.path.join(MODEL_PATH, 'best.h5')
 LATEST_PATH = os.path.join(MODEL_PATH, 'latest.h5')
 
 
-def load_data(all_history=False):
+def data_shards(all_history=False):
+    '''
+    学習に使うシャード [(パス, 使う局面数)]
 
-    # 学習データの読み込み
-    history_paths = Path(DATA_PATH).glob('*.history')
-    if not all_history:
-        history_paths = [sorted(history_paths)[-1]]
+    all_historyの時はリプレイバッファの範囲（最新の局面・世代）、それ以外は最新のシャードのみ。
+    '''
+
+    if all_history:
+        # 範囲外のシャードを削除・まとめてから範囲を決める
+        update_buffer()
+        return window_shards()
+    history_path = shard_paths()[-1]
+    return [(history_path, shard_size(history_path))]
 
-    data = []
-    for history_path in history_paths:
-        print('loading... ', history_path)
-        with history_path.open(mode='rb') as f:
-            data += pickle.load(f)
 
-    print("data size is ", len(data) / (BOARD_SIZE * BOARD_SIZE))
+def load_data(all_history=False, shards=None):
+    '''
+    学習データの読み込み（石の配置 (局面数, 2, 8, 8), 方策, 価値の列を返す）
+    '''
+
+    if shards is None:
+        shards = data_shards(all_history)
+    boards, policies, values = load_window(shards)
 
-    return data
+    print("data size is ", len(values))
+
+    return unpack_boards(boards), policies, values
+
+
+def augment(xs, policies):
+    '''
+    局面ごとに8通りの回転・反転からランダムに1つを盤面と方策（パスを除く）に適用
+    '''
+
+    a, b, c = DN_INPUT_SHAPE
+    xs = xs.copy()
+    policies = policies.copy()
+    ts = np.random.randint(8, size=len(xs))
+    for t in range(1, 8):
+        rows = ts == t
+        if not rows.any():
+            continue
+        # (局面数, 8, 8, ...) を (8, 8, 局面数, ...) にしてtransform_boardをまとめて適用
+        xs[rows] = transform_board(xs[rows].transpose(1, 2, 0, 3), t).transpose(2, 0, 1, 3)
+        p = policies[rows, :a * b].reshape(-1, a, b).transpose(1, 2, 0)
+        policies[rows, :a * b] = transform_board(p, t).transpose(2, 0, 1).reshape(-1, a * b)
+    return xs, policies
+
+
+def stream_data(shards):
+    '''
+    学習データを少しずつ読み込むtf.dataのデータセット
+
+    シャードの順番をエポックごとに入れ替えてメモリマップから順に読み、RN_SHUFFLE_BUFFER局面の
+    バッファでシャッフルしてバッチにまとめ、学習と並行して次のバッチを用意する。
+    RN_AUGMENTの時は読み込むたびに回転・反転を選び直すので、エポックごとに違う向きで学習する。
+    '''
+
+    import tensorflow as tf
+    a, b, c = DN_INPUT_SHAPE
+
+    def chunks():
+        for path, count in random.sample(shards, len(shards)):
+            boards, policies, values = read_shard(path)
+            for i in range(len(values) - count, len(values), RN_CHUNK_SIZE):
+                j = min(i + RN_CHUNK_SIZE, len(values))
+                xs = unpack_boards(boards[i:j]).transpose(0, 2, 3, 1)
+                y_policies = np.asarray(policies[i:j])
+                if RN_AUGMENT:
+                    xs, y_policies = augment(xs, y_policies)
+                yield xs, (y_policies, values[i:j].astype(np.float32))
+
+    dataset = tf.data.Dataset.from_generator(chunks, output_signature=(
+        tf.TensorSpec((None, a, b, c), tf.uint8),
+        (tf.TensorSpec((None, DN_OUTPUT_SIZE), tf.float16),
+         tf.TensorSpec((None,), tf.float32))))
+    dataset = dataset.unbatch().shuffle(RN_SHUFFLE_BUFFER).batch(RN_BATCH_SIZE)
+    dataset = dataset.map(lambda x, y: (tf.cast(x, tf.float32), y))
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def augmented_batches(xs, y_policies, y_values):
+    '''
+    メモリに載せた学習データのバッチ（エポックごとに並びを入れ替え、バッチごとに回転・反転を選び直す）
+    '''
+
+    while True:
+        order = np.random.permutation(len(y_values))
+        for i in range(0, len(order), RN_BATCH_SIZE):
+            rows = order[i:i + RN_BATCH_SIZE]
+            x, p = augment(xs[rows], y_policies[rows])
+            yield x.astype(np.float32), [p, y_values[rows]]
 
 
 def train_network(all_history=False):
@@ -46,18 +128,20 @@ def train_network(all_history=False):
     '''
     # 学習データの読み込み
     print("hoge", all_history)
-    history = load_data(all_history=all_history)
-    xs, y_policies, y_values = zip(*history)
+    shards = data_shards(all_history)
+    if RN_STREAMING:
+        # 学習データ全体をメモリに載せずに少しずつ読み込む
+        dataset = stream_data(shards)
+        print("data size is ", sum(count for _, count in shards))
+    else:
+        xs, y_policies, y_values = load_data(shards=shards)
 
-    # 学習のための入力データのシェイプの変換
-    a, b, c = DN_INPUT_SHAPE
-    xs = np.array(xs)
-    xs = xs.reshape(len(xs), c, a, b).transpose(0, 2, 3, 1)
-    y_policies = np.array(y_policies)
-    y_values = np.array(y_values)
+        # 学習のための入力データのシェイプの変換
+        xs = xs.transpose(0, 2, 3, 1)
+        y_values = y_values.astype(np.float32)
 
-    # ベストプレイヤーのモデルの読み込み
-    model = load_model(BEST_PATH)
+    # ベストプレイヤーのモデルの読み込み（学習で重みを書き換えるので専用の枠に毎回読み込む）
+    model = get_model(BEST_PATH, key='train', reload=True)
 
     # モデルのコンパイル
     model.compile(loss=['categorical_crossentropy', 'mse'], optimizer='adam')
@@ -78,17 +162,21 @@ def train_network(all_history=False):
         print('\rTrain {}/{}'.format(epoch + 1, RN_EPOCHS), end=''))
 
     # 学習の実行
-    model.fit(xs, [y_policies, y_values], batch_size=128, epochs=RN_EPOCHS,
-              verbose=0, callbacks=[lr_decay, print_callback])
+    if RN_STREAMING:
+        model.fit(dataset, epochs=RN_EPOCHS,
+                  verbose=0, callbacks=[lr_decay, print_callback])
+    elif RN_AUGMENT:
+        model.fit(augmented_batches(xs, y_policies, y_values),
+                  steps_per_epoch=-(-len(y_values) // RN_BATCH_SIZE), epochs=RN_EPOCHS,
+                  verbose=0, callbacks=[lr_decay, print_callback])
+    else:
+        model.fit(xs, [y_policies, y_values], batch_size=RN_BATCH_SIZE, epochs=RN_EPOCHS,
+                  verbose=0, callbacks=[lr_decay, print_callback])
     print('')
 
     # 最新プレイヤーのモデルの保存
     model.save(LATEST_PATH)
 
-    # モデルの破棄
-    K.clear_session()
-    del model
-
 
 # 動作確認
 if __name__ == '__main__':
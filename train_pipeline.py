@@ -0,0 +1,85 @@
+# ====================
+# 学習サイクルのパイプライン実行
+# ====================
+
+# パッケージのインポート
+# （spawnで起動したワーカーがこのモジュールを読み込み直す時にTensorFlowを読み込まないよう、
+# 学習・評価部はtrain_pipeline内で読み込む）
+from dual_network import dual_network
+from self_play import self_play, best_model
+from replay_buffer import shard_paths, shard_size
+from train_cycle import timeit
+import multiprocessing as mp
+import time
+
+# パラメータの準備
+TP_PROCESS_NUM = 2  # セルフプレイを続けるプロセス数
+TP_CYCLE_COUNT = 10  # 学習・評価の回数
+TP_POLL_INTERVAL = 1.0  # 新しい学習データを確認する間隔（秒）
+
+
+def self_play_worker(i, stop):
+    '''
+    セルフプレイを続けるワーカー（ベストプレイヤーが交代したらモデルを読み直す）
+    '''
+
+    while not stop.is_set():
+        # ベストプレイヤーのモデルの取得（交代していた時は重みのみ読み直す）
+        model = best_model()
+
+        # セルフプレイ（ゲームが終わるごとに学習データをログに追記）
+        self_play(i, model)
+
+
+def latest_history():
+    '''
+    最新の学習データのファイルと局面数（古いファイルは削除・まとめられるので数ではなく
+    最新のもので比べる。追記中のログは局面数が増えたら新しい学習データとみなす）
+    '''
+
+    paths = shard_paths()
+    return (paths[-1], shard_size(paths[-1])) if paths else None
+
+
+def train_pipeline():
+    '''
+    セルフプレイと学習・評価を並行して行う学習サイクル
+    '''
+
+    from train_network import train_network
+    from evaluate_network import evaluate_network
+
+    # デュアルネットワークの作成
+    dual_network()
+
+    # セルフプレイのワーカーの起動（TensorFlowの状態を引き継がないようspawnで起動）
+    ctx = mp.get_context('spawn')
+    stop = ctx.Event()
+    workers = [ctx.Process(target=self_play_worker, args=(i, stop))
+               for i in range(TP_PROCESS_NUM)]
+    for worker in workers:
+        worker.start()
+
+    trained = latest_history()
+    for i in range(TP_CYCLE_COUNT):
+        # 新しい学習データが保存されるまで待つ
+        while latest_history() == trained:
+            time.sleep(TP_POLL_INTERVAL)
+        trained = latest_history()
+
+        print('Train', i, '====================')
+        # パラメータ更新部
+        timeit(train_network)(all_history=True)
+
+        # 新パラメータ評価部（交代したらワーカーが次のセルフプレイから読み直す）
+        timeit(evaluate_network)()
+
+    # ワーカーの停止（実行中のセルフプレイが終わるまで待つ）
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+
+# 動作確認
+if __name__ == '__main__':
+    train_pipeline()